@@ -0,0 +1,266 @@
+import argparse
+import copy
+import importlib
+import json
+import logging
+import os
+import pdb
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import numpy as np  # type: ignore
+
+from sqlalchemy.engine import create_engine  # type: ignore
+
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List,
+)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from giggle.data import (  # noqa: E402
+    Data,
+    data_to_sparse_user_joke_matrix,
+    data_to_user_joke_matrix,
+)
+
+from giggle.recommender import (  # noqa: E402
+    RECOMMENDERS,
+    Neighbourhood,
+)
+
+from giggle.registry import save_version  # noqa: E402
+
+from giggle.similarity import build_similarities  # noqa: E402
+
+from giggle.synthetic import generate_data  # noqa: E402
+
+
+# Number of users and jokes; `large` has the size of the Jester dataset
+SIZES = {
+    'small': (5000, 100),
+    'medium': (20000, 150),
+    'large': (60000, 150),
+    'large_x10': (600000, 150),
+}
+SEED = 1337
+
+NR_PREDICT = 1000
+NR_PREDICT_MULTI = 100000
+NR_RECOMMEND = 1000
+NR_REQUESTS = 200
+
+
+def measure(func: Callable, nr_items: int=None, memory: bool=True) -> Dict[str, Any]:
+    # Times a first run and, separately, traces the peak of the allocated
+    # memory on a second run, since tracing slows down the Python code
+    start = time.time()
+    func()
+    result = {'seconds': time.time() - start}
+    if nr_items:
+        result['items_per_second'] = nr_items / result['seconds']
+    if memory:
+        tracemalloc.start()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result['peak_mb'] = peak / 2 ** 20
+    return result
+
+
+def measure_latencies(client_factory: Callable, urls: List[str], nr_threads: int) -> Dict[str, Any]:
+    # Sends the requests from concurrent clients and reports the throughput
+    # and the percentiles of the latency
+    latencies = []  # type: List[float]
+
+    def send(urls_):
+        client = client_factory()
+        for url in urls_:
+            start = time.time()
+            assert client.get(url).status_code == 200
+            latencies.append(time.time() - start)
+
+    threads = [threading.Thread(target=send, args=(urls[i::nr_threads], )) for i in range(nr_threads)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    result = {'seconds': time.time() - start}
+    result['items_per_second'] = len(urls) / result['seconds']
+    for q in (50, 95, 99):
+        result['p{:d}_ms'.format(q)] = 1000 * np.percentile(latencies, q)
+    return result
+
+
+def benchmark_data(data: Data, memory: bool) -> Dict[str, Any]:
+    user_joke_matrix = data_to_sparse_user_joke_matrix(data)
+    return {
+        'data_to_user_joke_matrix': measure(lambda: data_to_user_joke_matrix(data), memory=memory),
+        'data_to_sparse_user_joke_matrix': measure(lambda: data_to_sparse_user_joke_matrix(data), memory=memory),
+        'compute_similarities': measure(lambda: Neighbourhood(k=35)._compute_similarities(user_joke_matrix), memory=memory),
+        'build_similarities': measure(lambda: build_similarities(user_joke_matrix, nr_jobs=None), memory=memory),
+    }
+
+
+def benchmark_recommenders(data: Data, keys: List[str], memory: bool) -> Dict[str, Any]:
+    random_state = np.random.RandomState(SEED)
+    user_joke_ids = np.column_stack((
+        random_state.choice(data.users, NR_PREDICT_MULTI),
+        random_state.choice(data.jokes, NR_PREDICT_MULTI),
+    ))
+    user_ids = random_state.choice(data.users, NR_RECOMMEND)
+    data_frame = data.data_frame.set_index('user_id')
+    rated = [data_frame.joke_id.loc[[user_id]].tolist() for user_id in user_ids]
+    results = {}
+    for key in keys:
+        recommender = copy.deepcopy(RECOMMENDERS[key])
+        results['fit/' + key] = measure(lambda: recommender.fit(data, verbose=0), memory=memory)
+        results['predict/' + key] = measure(
+            lambda: [recommender.predict(u, j) for u, j in user_joke_ids[:NR_PREDICT]],
+            nr_items=NR_PREDICT,
+            memory=False,
+        )
+        results['predict_multi/' + key] = measure(
+            lambda: recommender.predict_multi(user_joke_ids),
+            nr_items=NR_PREDICT_MULTI,
+            memory=memory,
+        )
+        results['recommend/' + key] = measure(
+            lambda: recommender.recommend(user_ids, 5, rated=rated),
+            nr_items=NR_RECOMMEND,
+            memory=memory,
+        )
+    return results
+
+
+def benchmark_web(data: Data, key: str, path: str, memory: bool, nr_threads: int) -> Dict[str, Any]:
+    # Runs the handlers of the web service through Flask's test client,
+    # backed by a SQLite database that holds the synthetic ratings
+    from giggle.models import (
+        db,
+        insert_ratings,
+    )
+    db_path = os.path.join(path, 'ratings.db')
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    engine = create_engine('sqlite:///' + db_path)
+    db.metadata.create_all(engine)
+    with engine.begin() as connection:
+        insert_ratings(connection, [data.data_frame])
+    save_version(key, RECOMMENDERS[key].fit(data, verbose=0), keep=1, promote=True)
+
+    import giggle.web_service
+    web_service = importlib.reload(giggle.web_service)
+    logging.getLogger('web-service').setLevel(logging.WARNING)
+    client = web_service.app.test_client()
+
+    random_state = np.random.RandomState(SEED)
+    user_ids = random_state.choice(data.users, NR_REQUESTS)
+    joke_ids = random_state.choice(data.jokes, NR_REQUESTS)
+
+    def get(urls):
+        for url in urls:
+            assert client.get(url).status_code == 200
+
+    results = {
+        'web/predictInterests/' + key: measure(
+            lambda: get('/predictInterests/{:d}'.format(u) for u in user_ids),
+            nr_items=NR_REQUESTS,
+            memory=memory,
+        ),
+        'web/similarItems/' + key: measure(
+            lambda: get('/similarItems/{:d}'.format(j) for j in joke_ids),
+            nr_items=NR_REQUESTS,
+            memory=memory,
+        ),
+    }
+    if nr_threads > 1:
+        results['web/predictInterests/{}/{:d}_threads'.format(key, nr_threads)] = measure_latencies(
+            web_service.app.test_client,
+            ['/predictInterests/{:d}'.format(u) for u in user_ids],
+            nr_threads,
+        )
+    return results
+
+
+def print_results(results: Dict[str, Dict[str, Any]], reference: Dict[str, Dict[str, Any]]=None):
+    for size, size_results in results.items():
+        print('-- ' + size)
+        for name, result in size_results.items():
+            line = '{:40s} {:9.4f}s'.format(name, result['seconds'])
+            line += ' {:9.1f}MB'.format(result['peak_mb']) if 'peak_mb' in result else ' ' * 11
+            line += ' {:12.0f}/s'.format(result['items_per_second']) if 'items_per_second' in result else ' ' * 14
+            if 'p99_ms' in result:
+                line += ' p50 {p50_ms:.2f}ms p95 {p95_ms:.2f}ms p99 {p99_ms:.2f}ms'.format(**result)
+            if reference and name in reference.get(size, {}):
+                line += ' {:6.2f}x'.format(reference[size][name]['seconds'] / result['seconds'])
+            print(line)
+
+
+def get_git_commit() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the hot paths of the recommender system on synthetic data.',
+    )
+    parser.add_argument('-s', '--sizes', nargs='+', default=['small'], choices=SIZES, help='data sizes.')
+    parser.add_argument('-r', '--recommenders', nargs='+', default=list(RECOMMENDERS), choices=RECOMMENDERS, help='recommenders to fit.')
+    parser.add_argument('-w', '--web-recommender', default='neigh', choices=RECOMMENDERS, help='recommender served by the web benchmarks.')
+    parser.add_argument('--no-web', default=False, action='store_true', help='skip the web-service benchmarks.')
+    parser.add_argument('-t', '--threads', default=8, type=int, help='concurrent clients of the web service (1 to skip).')
+    parser.add_argument('--batch-window-ms', default=0, type=float, help='micro-batching window of the web service (0 to disable).')
+    parser.add_argument('--no-memory', default=False, action='store_true', help='skip the measurements of peak memory.')
+    parser.add_argument('-o', '--output', help='JSON file where to write the results.')
+    parser.add_argument('-c', '--compare', help='JSON file with previous results, for speed-up ratios.')
+    args = parser.parse_args()
+
+    memory = not args.no_memory
+    path = tempfile.mkdtemp(prefix='giggle-benchmarks-')
+
+    if not args.no_web:
+        # The web service expects its configuration at import time
+        os.environ.setdefault('SECRET_KEY', 'benchmarks')
+        os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(path, 'ratings.db')
+        os.environ['RECOMMENDER'] = args.web_recommender
+        os.environ['BATCH_WINDOW_MS'] = str(args.batch_window_ms)
+        os.makedirs(os.path.join(path, 'data', 'models'))
+        os.symlink(os.path.join(ROOT, 'config'), os.path.join(path, 'config'))
+        os.chdir(path)
+
+    results = {}  # type: Dict[str, Dict[str, Any]]
+    for size in args.sizes:
+        nr_users, nr_jokes = SIZES[size]
+        data = generate_data(nr_users=nr_users, nr_jokes=nr_jokes)
+        results[size] = {}
+        results[size].update(benchmark_data(data, memory))
+        results[size].update(benchmark_recommenders(data, args.recommenders, memory))
+        if not args.no_web:
+            results[size].update(benchmark_web(data, args.web_recommender, path, memory, args.threads))
+
+    reference = None
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            reference = json.load(f)['results']
+    print_results(results, reference)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'commit': get_git_commit(), 'time': time.time(), 'results': results}, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
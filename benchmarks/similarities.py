@@ -0,0 +1,78 @@
+import argparse
+import pdb
+import time
+
+import numpy as np  # type: ignore
+
+from scipy.sparse import (  # type: ignore
+    coo_matrix,
+    csr_matrix,
+)
+
+from giggle.recommender import Neighbourhood
+
+from giggle.similarity import MIN_SUPPORT
+
+
+def compute_similarities_loop(user_joke_matrix: np.array) -> np.array:
+    # Reference implementation: one Python iteration per pair of jokes
+    _, nr_jokes = user_joke_matrix.shape
+    joke_joke_matrix = np.zeros((nr_jokes, nr_jokes))
+    np.fill_diagonal(joke_joke_matrix, 1)
+    for i in range(nr_jokes):
+        for j in range(i + 1, nr_jokes):
+            common = np.logical_and(
+                np.logical_not(np.isnan(user_joke_matrix[:, i])),
+                np.logical_not(np.isnan(user_joke_matrix[:, j])),
+            )
+            if np.sum(common) < MIN_SUPPORT:
+                continue
+            r_i = user_joke_matrix[common, i] - user_joke_matrix[common, i].mean()
+            r_j = user_joke_matrix[common, j] - user_joke_matrix[common, j].mean()
+            numer = np.sum(r_i * r_j)
+            denom = np.sqrt(np.sum(r_i ** 2)) * np.sqrt(np.sum(r_j ** 2))
+            joke_joke_matrix[i, j] = joke_joke_matrix[j, i] = numer / denom
+    return joke_joke_matrix
+
+
+def random_user_joke_matrix(nr_users: int, nr_jokes: int, density: float) -> np.array:
+    rng = np.random.RandomState(1337)
+    user_joke_matrix = rng.uniform(-10, 10, size=(nr_users, nr_jokes)).round(2)
+    user_joke_matrix[rng.rand(nr_users, nr_jokes) > density] = np.nan
+    return user_joke_matrix
+
+
+def dense_to_sparse(user_joke_matrix: np.array) -> csr_matrix:
+    user_iids, joke_iids = np.where(np.logical_not(np.isnan(user_joke_matrix)))
+    ratings = user_joke_matrix[user_iids, joke_iids]
+    return coo_matrix((ratings, (user_iids, joke_iids)), shape=user_joke_matrix.shape).tocsr()
+
+
+def time_it(func, *args):
+    start = time.time()
+    result = func(*args)
+    return time.time() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compares the vectorized similarities against the pairwise loop.',
+    )
+    parser.add_argument('--nr-users', type=int, default=20000, help='number of users.')
+    parser.add_argument('--nr-jokes', type=int, default=100, help='number of jokes.')
+    parser.add_argument('--density', type=float, default=0.3, help='fraction of rated entries.')
+    args = parser.parse_args()
+
+    user_joke_matrix = random_user_joke_matrix(args.nr_users, args.nr_jokes, args.density)
+    time_loop, sims_loop = time_it(compute_similarities_loop, user_joke_matrix)
+    user_joke_sparse = dense_to_sparse(user_joke_matrix)
+    time_vect, sims_vect = time_it(Neighbourhood(k=35)._compute_similarities, user_joke_sparse)
+
+    print('{:12s} {:8.3f}s'.format('loop', time_loop))
+    print('{:12s} {:8.3f}s'.format('vectorized', time_vect))
+    print('{:12s} {:8.1f}x'.format('speed-up', time_loop / time_vect))
+    print('{:12s} {:8.2e}'.format('max abs diff', np.max(np.abs(sims_loop - sims_vect))))
+
+
+if __name__ == '__main__':
+    main()
@@ -21,15 +21,26 @@ def predict_interests(args):
     print(json.dumps(json.loads(response.text), indent=4))
 
 
+def predict_interests_batch(args):
+    URL = 'http://localhost:6667/predictInterestsBatch/'
+    data = {
+        "users": args.users,
+        "n": args.n,
+    }
+    response = requests.post(URL, json=data)
+    print(json.dumps(json.loads(response.text), indent=4))
+
+
 def similar_items(args):
-    URL = 'http://localhost:6667/similarItems/{:d}'
-    response = requests.get(URL.format(args.joke))
+    URL = 'http://localhost:6667/similarItems/{:d}?n={:d}'
+    response = requests.get(URL.format(args.joke, args.n))
     print(json.dumps(json.loads(response.text), indent=4))
 
 
 TODO = {
     'add': add_data,
     'predict': predict_interests,
+    'predict-batch': predict_interests_batch,
     'sims': similar_items,
 }
 
@@ -73,6 +84,24 @@ def main():
         help='user ID',
     )
 
+    parser_4 = subparsers.add_parser(
+        'predict-batch',
+        help='Predicts interests for multiple users at once',
+    )
+    parser_4.add_argument(
+        '-u', '--users',
+        type=int,
+        nargs='+',
+        required=True,
+        help='user IDs',
+    )
+    parser_4.add_argument(
+        '-n',
+        type=int,
+        default=5,
+        help='number of jokes per user',
+    )
+
     parser_3 = subparsers.add_parser(
         'sims',
         help='Finds similar jokes to given one',
@@ -83,6 +112,12 @@ def main():
         required=True,
         help='joke ID',
     )
+    parser_3.add_argument(
+        '-n',
+        type=int,
+        default=5,
+        help='number of similar jokes',
+    )
 
     args = parser.parse_args()
     TODO[args.command](args)
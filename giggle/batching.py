@@ -0,0 +1,202 @@
+import logging
+import os
+import pdb
+import threading
+import time
+
+from concurrent.futures import Future
+
+from queue import (
+    Empty,
+    Full,
+    Queue,
+)
+
+import numpy as np  # type: ignore
+
+from typing import (
+    Any,
+    Callable,
+    List,
+)
+
+from .metrics import (
+    Counter,
+    Gauge,
+    Histogram,
+)
+
+
+BATCH_SIZE = Histogram(
+    'giggle_batch_size', 'Requests scored together by the micro-batcher.',
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256),
+)
+BATCH_WAIT = Histogram('giggle_batch_wait_seconds', 'Time a request waits for its batch to be scored.')
+
+WRITE_QUEUE_DEPTH = Gauge('giggle_write_queue_depth', 'Rows waiting in the write-behind queue.')
+WRITE_FLUSH_SIZE = Histogram(
+    'giggle_write_flush_size', 'Rows written by each flush of the write-behind queue.',
+    buckets=(1, 10, 50, 100, 250, 500, 1000, 2500, 5000),
+)
+WRITE_FLUSH_LATENCY = Histogram('giggle_write_flush_duration_seconds', 'Duration of the flushes of the write-behind queue.')
+WRITES_REJECTED = Counter('giggle_writes_rejected_total', 'Rows refused because the write-behind queue was full.')
+WRITE_ERRORS = Counter('giggle_write_errors_total', 'Rows of the write-behind queue dropped because they could not be written.')
+
+
+def collect(queue: Queue, max_size: int, window: float) -> List[Any]:
+    # Waits for an item, then gathers the items that arrive within `window`
+    # seconds of it, up to `max_size` items
+    items = [queue.get()]
+    deadline = time.time() + window
+    while len(items) < max_size:
+        timeout = deadline - time.time()
+        if timeout <= 0:
+            break
+        try:
+            items.append(queue.get(timeout=timeout))
+        except Empty:
+            break
+    return items
+
+
+class MicroBatcher:
+    "Gathers concurrent calls to a batch function and runs them as one call"
+
+    def __init__(self, func: Callable[[np.array], np.array], window: float=0.002, max_batch_size: int=32) -> None:
+        # `func` maps an array of rows to a sequence of as many results; a
+        # batch is run `window` seconds after its first request arrived or
+        # as soon as it has `max_batch_size` requests
+        self.func = func
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self._lock = threading.Lock()
+        self._pid = None  # type: int
+
+    def _ensure_started(self):
+        # The worker thread is started on first use and again in forked
+        # processes, which do not inherit the threads of their parent
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = Queue()  # type: Queue
+            thread = threading.Thread(target=self._run, args=(self._queue, ), daemon=True)
+            thread.start()
+            self._pid = os.getpid()
+
+    def __call__(self, rows: np.array) -> np.array:
+        self._ensure_started()
+        future = Future()  # type: Future
+        self._queue.put((rows, future, time.time()))
+        return future.result()
+
+    def _run(self, queue: Queue):
+        while True:
+            batch = collect(queue, self.max_batch_size, self.window)
+            rows, futures, starts = zip(*batch)
+            try:
+                results = self.func(np.concatenate(rows))
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            BATCH_SIZE.observe(len(batch))
+            now = time.time()
+            end = 0
+            for rows_, future, start in batch:
+                BATCH_WAIT.observe(now - start)
+                future.set_result(results[end: end + len(rows_)])
+                end += len(rows_)
+
+
+class WriteBehind:
+    "Queues rows and writes them in batches from a background thread"
+
+    def __init__(self, func: Callable[[List[Any]], None], max_rows: int=500, max_delay: float=0.05, max_queue_size: int=10000, logger: logging.Logger=None, on_written: Callable[[List[Any]], None]=None) -> None:
+        # `func` writes a list of rows; a batch is written `max_delay`
+        # seconds after its first row was queued or as soon as it has
+        # `max_rows` rows. At most `max_queue_size` rows wait to be written.
+        # `on_written` is then called once with the rows of the batch that
+        # were written.
+        self.func = func
+        self.on_written = on_written
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.max_queue_size = max_queue_size
+        self.logger = logger
+        self._lock = threading.Lock()
+        self._pid = None  # type: int
+
+    def _ensure_started(self):
+        # As for `MicroBatcher`, forked processes start their own thread
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = Queue(self.max_queue_size)  # type: Queue
+            self._thread = threading.Thread(target=self._run, args=(self._queue, ), daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def put(self, row: Any) -> bool:
+        # Returns False, without waiting, if the queue is full
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(row)
+        except Full:
+            WRITES_REJECTED.inc()
+            return False
+        WRITE_QUEUE_DEPTH.set(self._queue.qsize())
+        return True
+
+    def close(self):
+        # Writes the queued rows and stops the thread; `None` marks the end
+        if self._pid != os.getpid():
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._pid = None
+
+    def _write(self, rows: List[Any]) -> List[Any]:
+        # If the batch fails, its rows are written one by one, so that only
+        # the failing ones are dropped (no request is waiting for them); `func`
+        # must hence write a batch entirely or not at all. Returns the rows
+        # written.
+        start = time.time()
+        try:
+            self.func(rows)
+        except Exception:
+            if len(rows) == 1:
+                WRITE_ERRORS.inc()
+                if self.logger:
+                    self.logger.exception("Failed to write the row {!r}, dropping it".format(rows[0]))
+                return []
+            if self.logger:
+                self.logger.warning("Failed to write {:d} rows, retrying them one by one".format(len(rows)))
+            return [row for row in rows if self._write([row])]
+        WRITE_FLUSH_SIZE.observe(len(rows))
+        WRITE_FLUSH_LATENCY.observe(time.time() - start)
+        return rows
+
+    def _flush(self, rows: List[Any]):
+        written = self._write(rows)
+        if not written or not self.on_written:
+            return
+        try:
+            self.on_written(written)
+        except Exception:
+            if self.logger:
+                self.logger.exception("Failed to handle {:d} written rows".format(len(written)))
+
+    def _run(self, queue: Queue):
+        while True:
+            rows = collect(queue, self.max_rows, self.max_delay)
+            WRITE_QUEUE_DEPTH.set(queue.qsize())
+            if None in rows:
+                rows = rows[:rows.index(None)]
+                if rows:
+                    self._flush(rows)
+                return
+            self._flush(rows)
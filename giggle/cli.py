@@ -3,6 +3,7 @@ import json
 import pdb
 import pickle
 import os
+import time
 
 from typing import (
     Any,
@@ -21,40 +22,177 @@ from .evaluate import (
     scatter_plot,
 )
 
-from .recommender import (
-    RECOMMENDERS,
-    get_recommender_path,
-    save_recommender,
+from .profiling import (
+    phase,
+    print_phases,
+    record,
 )
 
+from .recommender import RECOMMENDERS
+
+from .registry import (
+    get_current_version,
+    list_versions,
+    save_version,
+    set_current_version,
+)
+
+
+# Number of versions of a model kept by `train`
+KEEP_VERSIONS = 5
+
 
 def train(args):
     # Trains recommender system
-    dataset = DATASETS[args.dataset]()
+    dataset = DATASETS[args.dataset](refresh=args.refresh)
     recommender = RECOMMENDERS[args.recommender]
-    recommender.fit(dataset.get_data(), verbose=args.verbose)
-    save_recommender(get_recommender_path(args.recommender), recommender)
+    with phase('fit'):
+        recommender.fit(dataset.get_data(), verbose=args.verbose)
+    with phase('save'):
+        version = save_version(args.recommender, recommender, keep=args.keep, promote=args.promote)
+    print('Saved version {} of {}{}'.format(version, args.recommender, ' as the current one' if args.promote else ''))
 
 
 def evaluate(args):
     # Evaluates recommender system
-    dataset = DATASETS[args.dataset]()
+    dataset = DATASETS[args.dataset](refresh=args.refresh)
     recommender = RECOMMENDERS[args.recommender]
-    results, data = evaluate_folds(dataset, recommender, args.verbose)
+    results, data = evaluate_folds(dataset, recommender, args.verbose, nr_jobs=args.jobs)
     print_results(results)
     scatter_plot(data, path='data/plots/{}_{}.png'.format(args.recommender, args.dataset))
 
 
 def web(args):
     # Starts web-server
-    from .web_service import app
-    app.run('0.0.0.0', port=args.port, debug=False)
+    from .web_service import (
+        app,
+        before_fork,
+        follow_ratings,
+        logger,
+        shutdown,
+    )
+    if not args.workers:
+        app.run('0.0.0.0', port=args.port, debug=False, threaded=True)
+        return
+    # The model is loaded once, here, and shared by the forked workers
+    from .serving import PreforkServer
+    follow_ratings(args.workers)
+    server = PreforkServer(
+        app,
+        '0.0.0.0',
+        args.port,
+        args.workers,
+        before_fork=before_fork,
+        on_exit=shutdown,
+        graceful_timeout=args.graceful_timeout,
+        report_interval=args.report_interval,
+        logger=logger,
+    )
+    server.run()
+
+
+def generate(args):
+    # Generates synthetic ratings and optionally loads them into a database
+    from sqlalchemy import create_engine  # type: ignore
+    from .synthetic import (
+        JESTER_NR_USERS,
+        generate_ratings,
+        populate_database,
+        write_ratings_file,
+    )
+    nr_users = args.nr_users or int(args.scale * JESTER_NR_USERS)
+    chunks = generate_ratings(
+        nr_users=nr_users,
+        nr_jokes=args.nr_jokes,
+        nr_ratings_per_user=args.nr_ratings_per_user,
+        skew=args.skew,
+        seed=args.seed,
+    )
+    nr_rows = write_ratings_file(args.output, chunks)
+    print('Wrote {:d} ratings of {:d} users to {}'.format(nr_rows, nr_users, args.output))
+    if args.database:
+        populate_database(create_engine(args.database), args.output)
+
+
+def replay(args):
+    # Replays random requests against the web service, in-process, and adds
+    # the phases timed by its metrics to those of the profile
+    import numpy as np  # type: ignore
+    os.environ['RECOMMENDER'] = args.recommender
+    from . import web_service
+    client = web_service.app.test_client()
+    random_state = np.random.RandomState(1337)
+    users = np.array(sorted(web_service.rating_index.rated))
+    jokes = web_service.rating_index.jokes
+    has_similar_jokes = hasattr(web_service.model.recommender, 'similar_jokes')
+    for _ in range(args.nr_requests):
+        kind = random_state.rand()
+        if kind < 0.1:
+            data = json.dumps({'users': random_state.choice(users, 10).tolist()})
+            client.post('/predictInterestsBatch/', data=data, content_type='application/json')
+        elif kind < 0.2 and has_similar_jokes:
+            client.get('/similarItems/{:d}'.format(random_state.choice(jokes)))
+        else:
+            client.get('/predictInterests/{:d}'.format(random_state.choice(users)))
+    for (name, ), (counts, seconds) in web_service.PHASE_LATENCY.values.items():
+        record('web/' + name, seconds, sum(counts))
+
+
+PROFILE_TARGETS = {
+    'train': train,
+    'evaluate': evaluate,
+    'web': replay,
+}
+
+
+def profile(args):
+    # Runs a command under a sampling profiler or under cProfile
+    output = args.output or 'data/profiles/{}_{}'.format(args.target, args.recommender)
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    if args.profiler == 'sampling':
+        from .profiling import SamplingProfiler
+        profiler = SamplingProfiler(interval=args.interval)
+    else:
+        import cProfile
+        profiler = cProfile.Profile()
+    start = time.time()
+    profiler.enable()
+    try:
+        PROFILE_TARGETS[args.target](args)
+    finally:
+        profiler.disable()
+    wall = time.time() - start
+
+    print('-- Hot functions')
+    if args.profiler == 'sampling':
+        profiler.print_top(args.top)
+        profiler.write_collapsed(output + '.collapsed')
+        print('Wrote the collapsed stacks to {}.collapsed'.format(output))
+    else:
+        import pstats
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(args.top)
+        profiler.dump_stats(output + '.prof')
+        print('Wrote the profile to {}.prof'.format(output))
+    print('-- Phases ({:.3f}s in total)'.format(wall))
+    print_phases(wall)
+
+
+def models(args):
+    # Lists the versions of a model or changes the current one
+    if args.use:
+        set_current_version(args.recommender, args.use)
+    current = get_current_version(args.recommender)
+    for version in list_versions(args.recommender):
+        print('{} {}'.format('*' if version == current else ' ', version))
 
 
 TODO = {
     'train': train,
     'evaluate': evaluate,
     'web': web,
+    'generate': generate,
+    'profile': profile,
+    'models': models,
 }
 
 
@@ -85,6 +223,24 @@ def main():
         choices=RECOMMENDERS,
         help='which recommender type to use.',
     )
+    parser_1.add_argument(
+        '--keep',
+        default=KEEP_VERSIONS,
+        type=int,
+        help='number of versions of the model to keep.',
+    )
+    parser_1.add_argument(
+        '--promote',
+        default=False,
+        action='store_true',
+        help='make the new version the one served.',
+    )
+    parser_1.add_argument(
+        '--refresh',
+        default=False,
+        action='store_true',
+        help='reload the ratings instead of using the local snapshot.',
+    )
     parser_1.add_argument(
         '-v', '--verbose',
         default=0,
@@ -116,6 +272,18 @@ def main():
         action='store_true',
         help='plot accuracy vs. throughput (only for the fields to be extracted).',
     )
+    parser_2.add_argument(
+        '-j', '--jobs',
+        default=1,
+        type=int,
+        help='number of folds to evaluate in parallel.',
+    )
+    parser_2.add_argument(
+        '--refresh',
+        default=False,
+        action='store_true',
+        help='reload the ratings instead of using the local snapshot.',
+    )
     parser_2.add_argument(
         '-v', '--verbose',
         default=0,
@@ -135,6 +303,24 @@ def main():
         type=int,
         help='port number.',
     )
+    parser_3.add_argument(
+        '-w', '--workers',
+        default=0,
+        type=int,
+        help='number of worker processes sharing the model (default: the development server).',
+    )
+    parser_3.add_argument(
+        '--graceful-timeout',
+        default=30.0,
+        type=float,
+        help='seconds a stopping worker has to finish its requests.',
+    )
+    parser_3.add_argument(
+        '--report-interval',
+        default=300.0,
+        type=float,
+        help='seconds between the reports of the memory of the workers (0 to disable).',
+    )
     parser_3.add_argument(
         '-v', '--verbose',
         default=0,
@@ -142,6 +328,144 @@ def main():
         help='show more output.',
     )
 
+    # Sub-parser for synthetic data
+    parser_4 = subparsers.add_parser(
+        'generate',
+        help='Generates synthetic Jester-like ratings',
+    )
+    parser_4.add_argument(
+        '-o', '--output',
+        default='data/synthetic/jester_ratings.dat',
+        help='file where to write the ratings.',
+    )
+    parser_4.add_argument(
+        '-s', '--scale',
+        default=1.0,
+        type=float,
+        help='number of users, as a multiple of those in the Jester dataset.',
+    )
+    parser_4.add_argument(
+        '--nr-users',
+        type=int,
+        help='number of users (overrides the scale).',
+    )
+    parser_4.add_argument(
+        '--nr-jokes',
+        default=150,
+        type=int,
+        help='number of jokes.',
+    )
+    parser_4.add_argument(
+        '--nr-ratings-per-user',
+        default=30,
+        type=float,
+        help='average number of ratings per user.',
+    )
+    parser_4.add_argument(
+        '--skew',
+        default=1.0,
+        type=float,
+        help='exponent of the popularity of the jokes (0 for uniform).',
+    )
+    parser_4.add_argument(
+        '--seed',
+        default=1337,
+        type=int,
+        help='seed of the random generator.',
+    )
+    parser_4.add_argument(
+        '--database',
+        help='database where to load the ratings, e.g. sqlite:///data/synthetic/jester.db',
+    )
+
+    # Sub-parser for profiling
+    parser_5 = subparsers.add_parser(
+        'profile',
+        help='Profiles training, evaluation or the web-service',
+    )
+    parser_5.add_argument(
+        'target',
+        choices=PROFILE_TARGETS,
+        help='what to profile; `web` replays requests on the trained model.',
+    )
+    parser_5.add_argument(
+        '-d', '--dataset',
+        default='small',
+        choices=DATASETS,
+        help='which dataset to use.',
+    )
+    parser_5.add_argument(
+        '-r', '--recommender',
+        required=True,
+        choices=RECOMMENDERS,
+        help='which recommender type to use.',
+    )
+    parser_5.add_argument(
+        '-p', '--profiler',
+        default='sampling',
+        choices=('sampling', 'cprofile'),
+        help='sampling profiler (collapsed stacks) or deterministic profiler.',
+    )
+    parser_5.add_argument(
+        '--interval',
+        default=0.005,
+        type=float,
+        help='sampling interval in seconds.',
+    )
+    parser_5.add_argument(
+        '--top',
+        default=20,
+        type=int,
+        help='number of hot functions to show.',
+    )
+    parser_5.add_argument(
+        '-o', '--output',
+        help='path of the output files, without extension.',
+    )
+    parser_5.add_argument(
+        '-n', '--nr-requests',
+        default=1000,
+        type=int,
+        help='number of requests to replay.',
+    )
+    parser_5.add_argument(
+        '-j', '--jobs',
+        default=1,
+        type=int,
+        help='number of folds to evaluate in parallel (only the main process is profiled).',
+    )
+    parser_5.add_argument(
+        '--refresh',
+        default=False,
+        action='store_true',
+        help='reload the ratings instead of using the local snapshot.',
+    )
+    parser_5.add_argument(
+        '-v', '--verbose',
+        default=0,
+        action='count',
+        help='show more output.',
+    )
+    # Profiling never changes the version served
+    parser_5.set_defaults(keep=KEEP_VERSIONS, promote=False)
+
+    # Sub-parser for the model registry
+    parser_6 = subparsers.add_parser(
+        'models',
+        help='Lists the saved versions of a model, the current one marked with *',
+    )
+    parser_6.add_argument(
+        '-r', '--recommender',
+        required=True,
+        choices=RECOMMENDERS,
+        help='which recommender type to use.',
+    )
+    parser_6.add_argument(
+        '--use',
+        default=None,
+        help='version to make current; the web services load it within MODEL_POLL_SECONDS.',
+    )
+
     args = parser.parse_args()
     TODO[args.command](args)
 
@@ -1,6 +1,10 @@
+import hashlib
+import json
 import os
 import pdb
 import random
+import shutil
+import tempfile
 
 from collections import namedtuple
 
@@ -14,24 +18,38 @@ import matplotlib.pyplot as plt  # type: ignore
 
 import numpy as np  # type: ignore
 
+from numpy.lib.format import open_memmap  # type: ignore
+
 from pandas import (  # type: ignore
     DataFrame,
+    Series,
+    read_csv,
     read_sql_table,
 )
 
+from scipy.sparse import (  # type: ignore
+    coo_matrix,
+    csr_matrix,
+)
+
 from sklearn.model_selection import KFold  # type: ignore
 
+from sqlalchemy import text  # type: ignore
+
 from sqlalchemy.engine import create_engine  # type: ignore
 
 from typing import (
     Any,
     Callable,
     Dict,
+    Iterable,
     List,
     Optional,
     Tuple,
 )
 
+from .profiling import phase
+
 
 SEED = 1337
 
@@ -40,24 +58,168 @@ SEED = 1337
 Data = namedtuple('Data', 'data_frame users jokes user_to_iid joke_to_iid')
 
 
+CACHE_DIR = 'data/cache'
+CACHE_FORMAT = 2
+RATINGS_PATH = 'data/jester/jester_ratings.dat'
+RATINGS_DTYPES = (
+    ('user_id', np.int32),
+    ('joke_id', np.int32),
+    ('rating', np.float32),
+)
+
+
+CHUNK_SIZE = 100000
+
+
+def compact_chunks(chunks: Iterable[DataFrame]) -> Iterable[DataFrame]:
+    # Downcasts each chunk of ratings as soon as it is read
+    for chunk in chunks:
+        yield DataFrame({
+            column: chunk[column].values.astype(dtype)
+            for column, dtype in RATINGS_DTYPES
+        }, columns=[column for column, _ in RATINGS_DTYPES])
+
+
+def read_ratings_file(path: str, dtypes=RATINGS_DTYPES) -> Iterable[DataFrame]:
+    return read_csv(
+        path,
+        sep=r'\s+',
+        header=None,
+        names=[column for column, _ in dtypes],
+        dtype=dict(dtypes),
+        chunksize=CHUNK_SIZE,
+    )
+
+
+def count_lines(path: str) -> int:
+    nr_lines = 0
+    block = b''
+    with open(path, 'rb') as f:
+        for block in iter(partial(f.read, 2 ** 20), b''):
+            nr_lines += block.count(b'\n')
+    # The last line may miss its line ending
+    return nr_lines + int(not block.endswith(b'\n'))
+
+
+def read_ratings_table(con) -> Iterable[DataFrame]:
+    # Server-side cursor, so that the rows are fetched chunk by chunk
+    with con.connect() as connection:
+        connection = connection.execution_options(stream_results=True)
+        for chunk in read_sql_table('ratings', connection, chunksize=CHUNK_SIZE):
+            yield chunk
+
+
+def get_database_version(con) -> List[int]:
+    # Cheap summary of the ratings table that changes when rows are added or
+    # ratings are changed; the ratings are summed in thousandths, which keeps
+    # the sum exact whatever the order of the rows
+    query = text('SELECT COUNT(*), MAX(user_id), MAX(joke_id), SUM(ROUND(rating * 1000)) FROM ratings')
+    with con.connect() as connection:
+        return [int(value or 0) for value in connection.execute(query).fetchone()]
+
+
+def get_cache_path(source: str) -> str:
+    key = hashlib.sha1(source.encode('utf-8')).hexdigest()[:10]
+    return os.path.join(CACHE_DIR, 'ratings.{}'.format(key))
+
+
+def read_cache_version(path: str) -> Optional[List[int]]:
+    try:
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+    except (IOError, ValueError):
+        return None
+    # Snapshots in an older format are rebuilt
+    return meta['version'] if meta.get('format') == CACHE_FORMAT else None
+
+
+def write_cache(path: str, chunks: Iterable[DataFrame], nr_rows: int, version: List[int]):
+    # Streams the chunks into memory-mapped columns of a temporary folder,
+    # which then replaces the previous snapshot; the sorted identifiers of
+    # the users and jokes are gathered along the way. Rows beyond `nr_rows`
+    # were added while reading and are left for the next snapshot.
+    tmp_path = tempfile.mkdtemp(prefix='.ratings-', dir=os.path.dirname(path))
+    columns = {
+        column: open_memmap(os.path.join(tmp_path, column + '.npy'), mode='w+', dtype=dtype, shape=(nr_rows, ))
+        for column, dtype in RATINGS_DTYPES
+    }
+    # The identifiers of each chunk, merged once at the end
+    users = [np.zeros(0, dtype=np.int32)]
+    jokes = [np.zeros(0, dtype=np.int32)]
+    start = 0
+    for chunk in compact_chunks(chunks):
+        chunk = chunk[:nr_rows - start]
+        end = start + len(chunk)
+        for column, values in columns.items():
+            values[start: end] = chunk[column].values
+        users.append(np.unique(chunk.user_id.values))
+        jokes.append(np.unique(chunk.joke_id.values))
+        start = end
+    users = np.unique(np.concatenate(users))
+    jokes = np.unique(np.concatenate(jokes))
+    for column, values in columns.items():
+        values.flush()
+        if start < nr_rows:
+            np.save(os.path.join(tmp_path, column + '.npy'), np.array(values[:start]))
+    np.save(os.path.join(tmp_path, 'users.npy'), users)
+    np.save(os.path.join(tmp_path, 'jokes.npy'), jokes)
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump({'format': CACHE_FORMAT, 'version': version, 'nr_rows': start}, f)
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmp_path, path)
+
+
+def read_cache(path: str) -> Tuple[DataFrame, np.array, np.array]:
+    # The columns of the data frame are the memory-mapped arrays themselves
+    load = lambda name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+    data_frame = DataFrame({
+        column: load(column)
+        for column, _ in RATINGS_DTYPES
+    }, columns=[column for column, _ in RATINGS_DTYPES], copy=False)
+    return data_frame, load('users'), load('jokes')
+
+
+def load_ratings(refresh: bool=False) -> Tuple[DataFrame, np.array, np.array]:
+    # Loads the ratings and the sorted identifiers of users and jokes from a
+    # local snapshot, which is rebuilt if missing, if the source has changed
+    # or if `refresh` is set. The source is the database given by
+    # `DATABASE_URL` or, otherwise, the Jester ratings file.
+    url = os.getenv('DATABASE_URL')
+    if url:
+        con = create_engine(url)
+        path = get_cache_path(url)
+        version = get_database_version(con)
+        nr_rows = version[0]
+        read_ratings = partial(read_ratings_table, con)
+    else:
+        path = get_cache_path(os.path.abspath(RATINGS_PATH))
+        version = [os.path.getsize(RATINGS_PATH), int(os.path.getmtime(RATINGS_PATH))]
+        nr_rows = count_lines(RATINGS_PATH)
+        read_ratings = partial(read_ratings_file, RATINGS_PATH)
+    if refresh or read_cache_version(path) != version:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        write_cache(path, read_ratings(), nr_rows, version)
+    return read_cache(path)
+
+
 class Dataset:
 
-    def __init__(self, nr_folds: int, subsample: Optional[Callable]=None) -> None:
+    def __init__(self, nr_folds: int, subsample: Optional[Callable]=None, refresh: bool=False) -> None:
         self.nr_folds = nr_folds
-        self.data_frame = self._load_data_frame(subsample)
+        with phase('load'):
+            self.data_frame, self.users, self.jokes = self._load_data_frame(subsample, refresh)
         self.folds = self._get_folds()
-        self.users = sorted(self.data_frame.user_id.unique())
-        self.jokes = sorted(self.data_frame.joke_id.unique())
-        self.user_to_iid = dict(zip(self.users, count()))
-        self.joke_to_iid = dict(zip(self.jokes, count()))
-
-    def _load_data_frame(self, subsample: Optional[Callable]) -> DataFrame:
-        url = os.getenv('DATABASE_URL')
-        con = create_engine(url)
-        # self.data_frame = next(read_sql_table('ratings', con, chunksize=5000))
-        data_frame = read_sql_table('ratings', con)
-        data_frame = subsample(data_frame) if subsample else data_frame
-        return data_frame
+        self.user_to_iid = dict(zip(self.users.tolist(), count()))
+        self.joke_to_iid = dict(zip(self.jokes.tolist(), count()))
+
+    def _load_data_frame(self, subsample: Optional[Callable], refresh: bool) -> Tuple[DataFrame, np.array, np.array]:
+        # Subsampling works on the compact snapshot, which is memory-mapped
+        data_frame, users, jokes = load_ratings(refresh)
+        if subsample:
+            data_frame = subsample(data_frame)
+            users = np.unique(data_frame.user_id.values)
+            jokes = np.unique(data_frame.joke_id.values)
+        return data_frame, users, jokes
 
     def _get_folds(self) -> Dict[int, Dict[str, Any]]:
         index = np.arange(len(self.data_frame))
@@ -84,6 +246,69 @@ class Dataset:
             data_frame = self.data_frame
         return Data(data_frame, self.users, self.jokes, self.user_to_iid, self.joke_to_iid)
 
+    def get_fold_data(self, idxs: List[int]) -> Data:
+        return self.get_data(self.data_frame.iloc[idxs])
+
+
+class SharedArrays:
+    # Named arrays stored as `.npy` files in a temporary folder (in shared
+    # memory, if available), which worker processes memory-map by its path
+    # instead of receiving a copy of the arrays
+
+    def __init__(self, arrays: Dict[str, np.array]) -> None:
+        shm = '/dev/shm'
+        self.path = tempfile.mkdtemp(prefix='giggle-', dir=shm if os.path.isdir(shm) else None)
+        for name, array in arrays.items():
+            np.save(self.get_path(name), array)
+
+    def get_path(self, name: str) -> str:
+        return os.path.join(self.path, name + '.npy')
+
+    def close(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+def load_shared_array(path: str, name: str) -> np.array:
+    return np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+
+
+def share_dataset(dataset: Dataset) -> SharedArrays:
+    # The rating columns, the test fold of each rating and the identifiers
+    # of users and jokes, from which `SharedDataset` rebuilds the dataset
+    fold = np.zeros(len(dataset.data_frame), dtype=np.int32)
+    for i in range(dataset.nr_folds):
+        fold[dataset.folds[i]['te']] = i
+    arrays = {column: dataset.data_frame[column].values for column in SharedDataset.COLUMNS}
+    arrays.update({'fold': fold, 'users': dataset.users, 'jokes': dataset.jokes})
+    return SharedArrays(arrays)
+
+
+class SharedDataset:
+    # A dataset opened by a worker process from the shared arrays written
+    # by `share_dataset`, so that only their path is sent to the worker; the
+    # folds are sliced by index from the memory-mapped columns.
+
+    COLUMNS = ('user_id', 'joke_id', 'rating')
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.fold = load_shared_array(path, 'fold')
+        self.users = np.array(load_shared_array(path, 'users'))
+        self.jokes = np.array(load_shared_array(path, 'jokes'))
+        self.user_to_iid = dict(zip(self.users.tolist(), count()))
+        self.joke_to_iid = dict(zip(self.jokes.tolist(), count()))
+
+    def load_fold(self, i: int) -> Tuple[List[int], List[int]]:
+        # As those of `KFold`, the indices are sorted
+        return np.flatnonzero(self.fold != i), np.flatnonzero(self.fold == i)
+
+    def get_fold_data(self, idxs: List[int]) -> Data:
+        data_frame = DataFrame({
+            column: load_shared_array(self.path, column)[idxs]
+            for column in self.COLUMNS
+        }, columns=self.COLUMNS)
+        return Data(data_frame, self.users, self.jokes, self.user_to_iid, self.joke_to_iid)
+
 
 def pick_from_random_users(data_frame: DataFrame, nr_users: int) -> DataFrame:
     "Pick ratings from random users"
@@ -97,20 +322,62 @@ pick_from_1500_random_users = lambda d: pick_from_random_users(d, nr_users=1500)
 
 
 DATASETS = {
-    'large': lambda: Dataset(nr_folds=3),
-    'small': lambda: Dataset(nr_folds=3, subsample=pick_from_1500_random_users),
+    'large': lambda **kwargs: Dataset(nr_folds=3, **kwargs),
+    'small': lambda **kwargs: Dataset(nr_folds=3, subsample=pick_from_1500_random_users, **kwargs),
 }
 
 
+def data_to_iids(data: Data) -> Tuple[np.array, np.array]:
+    user_iids = data.data_frame.user_id.map(data.user_to_iid).values
+    joke_iids = data.data_frame.joke_id.map(data.joke_to_iid).values
+    return user_iids, joke_iids
+
+
+def ids_to_iids(ids: Iterable[int], id_to_iid: Dict[int, int]) -> np.array:
+    # Maps identifiers to indices, the unknown identifiers are mapped to -1.
+    # Pandas converts the map to a series on each call, so few identifiers
+    # are looked up one by one.
+    ids = np.asarray(ids)
+    if len(ids) < len(id_to_iid):
+        get = id_to_iid.get
+        return np.array([get(id_, -1) for id_ in ids.tolist()], dtype=np.int64)
+    return Series(ids).map(id_to_iid).fillna(-1).values.astype(np.int64)
+
+
+def iids_to_ids(id_to_iid: Dict[int, int]) -> np.array:
+    # Inverse of an identifier map, as the array of identifiers
+    ids = np.zeros(len(id_to_iid), dtype=np.int64)
+    ids[list(id_to_iid.values())] = list(id_to_iid.keys())
+    return ids
+
+
 def data_to_user_joke_matrix(data: Data) -> np.array:
     n_users = len(data.users)
     n_jokes = len(data.jokes)
     user_joke_matrix = np.full((n_users, n_jokes), np.nan)
-    for _, u, j, r in data.data_frame.itertuples():
-        user_joke_matrix[data.user_to_iid[u], data.joke_to_iid[j]] = r
+    user_iids, joke_iids = data_to_iids(data)
+    user_joke_matrix[user_iids, joke_iids] = data.data_frame.rating.values
     return user_joke_matrix
 
 
+def data_to_sparse_user_joke_matrix(data: Data) -> csr_matrix:
+    # Stores only the observed ratings; note that a rating of zero is kept as
+    # an explicit entry, so the sparsity structure marks the rated jokes.
+    n_users = len(data.users)
+    n_jokes = len(data.jokes)
+    user_iids, joke_iids = data_to_iids(data)
+    ratings = data.data_frame.rating.values.astype(np.float64)
+    return coo_matrix((ratings, (user_iids, joke_iids)), shape=(n_users, n_jokes)).tocsr()
+
+
+def sparse_to_rated_matrix(user_joke_matrix: csr_matrix) -> csr_matrix:
+    # Binary matrix with the same sparsity structure as the ratings
+    return csr_matrix(
+        (np.ones_like(user_joke_matrix.data), user_joke_matrix.indices, user_joke_matrix.indptr),
+        shape=user_joke_matrix.shape,
+    )
+
+
 def iqr(xs):
     q75, q25 = np.percentile(xs, [75, 25])
     return q75 - q25
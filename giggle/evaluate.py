@@ -1,5 +1,9 @@
 import pdb
 
+from concurrent.futures import ProcessPoolExecutor
+
+from functools import partial
+
 import matplotlib.pyplot as plt  # type: ignore
 
 import numpy as np  # type: ignore
@@ -19,8 +23,12 @@ from typing import (
 from .data import (
     Data,
     Dataset,
+    SharedDataset,
+    share_dataset,
 )
 
+from .profiling import phase
+
 from .recommender import (
     Recommender,
     rmse,
@@ -31,19 +39,35 @@ def evaluate_fold(i: int, dataset: Dataset, recommender: Recommender, verbose: i
     if verbose:
         print('-- Fold', i)
     tr_idxs, te_idxs = dataset.load_fold(i)
-    tr_data = dataset.get_data(dataset.data_frame.ix[tr_idxs])
-    te_data = dataset.get_data(dataset.data_frame.ix[te_idxs])
-    recommender.fit(tr_data, verbose)
+    tr_data = dataset.get_fold_data(tr_idxs)
+    te_data = dataset.get_fold_data(te_idxs)
+    with phase('fit'):
+        recommender.fit(tr_data, verbose)
     true = te_data.data_frame.rating.values
-    pred = recommender.predict_multi(te_data.data_frame[['user_id', 'joke_id']].values)
+    with phase('predict'):
+        pred = recommender.predict_multi(te_data.data_frame[['user_id', 'joke_id']].values)
     return rmse(true, pred), (true, pred)
 
 
-def evaluate_folds(dataset: Dataset, recommender: Recommender, verbose: int=0) -> Tuple[Tuple[float], Tuple[Any]]:
-    return tuple(zip(*[
-        evaluate_fold(i, dataset, recommender, verbose)
-        for i in range(dataset.nr_folds)
-    ]))
+def evaluate_shared_fold(i: int, path: str, recommender: Recommender, verbose: int=0) -> Tuple[float, Any]:
+    return evaluate_fold(i, SharedDataset(path), recommender, verbose)
+
+
+def evaluate_folds(dataset: Dataset, recommender: Recommender, verbose: int=0, nr_jobs: int=1) -> Tuple[Tuple[float], Tuple[Any]]:
+    if nr_jobs == 1:
+        return tuple(zip(*[
+            evaluate_fold(i, dataset, recommender, verbose)
+            for i in range(dataset.nr_folds)
+        ]))
+    # Each fold is evaluated in its own process on the shared ratings, which
+    # the workers open by their path
+    shared_arrays = share_dataset(dataset)
+    try:
+        evaluate_fold_ = partial(evaluate_shared_fold, path=shared_arrays.path, recommender=recommender, verbose=verbose)
+        with ProcessPoolExecutor(max_workers=nr_jobs) as executor:
+            return tuple(zip(*executor.map(evaluate_fold_, range(dataset.nr_folds))))
+    finally:
+        shared_arrays.close()
 
 
 def print_results(results: List[float]):
@@ -0,0 +1,56 @@
+import pdb
+
+from threading import Lock
+
+import numpy as np  # type: ignore
+
+from typing import (
+    Dict,
+    Iterable,
+    List,
+    Tuple,
+)
+
+from .utils import grouper
+
+
+class RatingIndex:
+    "Joke catalog and the jokes rated by each user, as sorted catalog indices"
+
+    def __init__(self, jokes: np.array, rated: Dict[int, np.array]) -> None:
+        self.jokes = jokes
+        self.joke_to_iid = {joke_id: iid for iid, joke_id in enumerate(jokes.tolist())}
+        self.rated = rated
+        self.lock = Lock()
+
+    @classmethod
+    def from_pairs(cls, pairs: Iterable[Tuple[int, int]], chunk_size: int=10000) -> 'RatingIndex':
+        # Builds the index in one pass over the (user_id, joke_id) pairs
+        chunks = []
+        for chunk in grouper(pairs, chunk_size):
+            chunk = [pair for pair in chunk if pair is not None]
+            chunks.append(np.array(chunk, dtype=np.int64).reshape(-1, 2))
+        user_joke_ids = np.vstack(chunks) if chunks else np.zeros((0, 2), dtype=np.int64)
+        user_ids = user_joke_ids[:, 0]
+        jokes, joke_iids = np.unique(user_joke_ids[:, 1], return_inverse=True)
+        joke_iids = joke_iids.astype(np.int32)
+        idxs = np.lexsort((joke_iids, user_ids))
+        user_ids = user_ids[idxs]
+        joke_iids = joke_iids[idxs]
+        users, starts = np.unique(user_ids, return_index=True)
+        rated = dict(zip(users.tolist(), np.split(joke_iids, starts[1:])))
+        return cls(jokes, rated)
+
+    def add(self, user_id: int, joke_id: int):
+        with self.lock:
+            if joke_id not in self.joke_to_iid:
+                self.joke_to_iid[joke_id] = len(self.jokes)
+                self.jokes = np.append(self.jokes, joke_id)
+            joke_iid = self.joke_to_iid[joke_id]
+            rated = self.rated.get(user_id, np.zeros(0, dtype=np.int32))
+            i = np.searchsorted(rated, joke_iid)
+            if i == len(rated) or rated[i] != joke_iid:
+                self.rated[user_id] = np.insert(rated, i, joke_iid)
+
+    def get_rated_jokes(self, user_id: int) -> List[int]:
+        return self.jokes[self.rated.get(user_id, [])].tolist()
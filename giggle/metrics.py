@@ -0,0 +1,155 @@
+import math
+import pdb
+import time
+
+from bisect import bisect_left
+
+from collections import OrderedDict
+
+from contextlib import contextmanager
+
+from threading import Lock
+
+from typing import (
+    Dict,
+    Iterator,
+    List,
+    Sequence,
+    Tuple,
+)
+
+
+# Metrics in the text format of Prometheus, see
+# https://prometheus.io/docs/instrumenting/exposition_formats/
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Seconds; finer than the defaults of Prometheus, since most of the phases
+# of a request take less than a millisecond
+DEFAULT_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+
+class Metric:
+
+    TYPE = ''
+
+    def __init__(self, name: str, help: str, labels: Sequence[str]=(), registry: 'OrderedDict[str, Metric]'=None) -> None:
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}  # type: Dict[Tuple[str, ...], object]
+        self.lock = Lock()
+        # A metric of the same name, e.g. from a reloaded module, is replaced
+        (REGISTRY if registry is None else registry)[name] = self
+
+    def _key(self, labels: Dict[str, object]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labels):
+            message = "Metric {} expects the labels {}, but got {}"
+            raise ValueError(message.format(self.name, self.labels, tuple(labels)))
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def _format_labels(self, key: Tuple[str, ...], extra: Sequence[Tuple[str, str]]=()) -> str:
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(label, escape(value)) for label, value in pairs) + '}'
+
+    def _samples(self) -> Iterator[Tuple[str, str, float]]:
+        for key, value in sorted(self.values.items()):
+            yield self.name, self._format_labels(key), value
+
+    def render(self) -> List[str]:
+        lines = [
+            '# HELP {} {}'.format(self.name, self.help),
+            '# TYPE {} {}'.format(self.name, self.TYPE),
+        ]
+        with self.lock:
+            samples = list(self._samples())
+        lines.extend('{}{} {}'.format(name, labels, format_value(value)) for name, labels, value in samples)
+        return lines
+
+
+class Counter(Metric):
+
+    TYPE = 'counter'
+
+    def inc(self, amount: float=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+
+    TYPE = 'gauge'
+
+    def inc(self, amount: float=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount: float=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+
+    TYPE = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: Sequence[str]=(), buckets: Sequence[float]=DEFAULT_BUCKETS, registry: 'OrderedDict[str, Metric]'=None) -> None:
+        super().__init__(name, help, labels, registry)
+        self.buckets = tuple(float(bound) for bound in sorted(buckets)) + (math.inf, )
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = [[0] * len(self.buckets), 0.0]
+            # Buckets are stored non-cumulative and summed when rendering
+            self.values[key][0][bisect_left(self.buckets, value)] += 1
+            self.values[key][1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def _samples(self) -> Iterator[Tuple[str, str, float]]:
+        for key, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = self._format_labels(key, [('le', format_value(bound))])
+                yield self.name + '_bucket', labels, cumulative
+            yield self.name + '_sum', self._format_labels(key), total
+            yield self.name + '_count', self._format_labels(key), cumulative
+
+
+REGISTRY = OrderedDict()  # type: OrderedDict[str, Metric]
+
+
+def escape(value: str) -> str:
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(registry: 'OrderedDict[str, Metric]'=None) -> str:
+    lines = []  # type: List[str]
+    for metric in (REGISTRY if registry is None else registry).values():
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
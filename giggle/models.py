@@ -1,24 +1,38 @@
 import argparse
 import pdb
+import time
 
 from flask import Flask  # type: ignore
 
 from flask_sqlalchemy import SQLAlchemy  # type: ignore
 
-from functools import partial
+from io import StringIO
 
 import names  # type: ignore
 
 import numpy as np  # type: ignore
 
+from pandas import DataFrame  # type: ignore
+
 from sqlalchemy.orm import validates  # type: ignore
 
 from sqlalchemy import (  # type: ignore
     PrimaryKeyConstraint,
     UniqueConstraint,
+    text,
 )
 
-from .config import Config
+from typing import (
+    Dict,
+    Iterable,
+    List,
+    Tuple,
+)
+
+from .data import (
+    RATINGS_PATH,
+    read_ratings_file,
+)
 
 from .utils import grouper
 
@@ -80,17 +94,189 @@ class Rating(db.Model):  # type: ignore
             return value
 
 
-def get_users(nr_users):
-    return (User(name=names.get_full_name()) for _ in range(nr_users))
+class RatingLog(db.Model):  # type: ignore
+    "Ratings added by the web service, in the order they were written"
 
+    __tablename__ = 'rating_log'
 
-def get_jokes(nr_jokes):
-    return (Joke() for _ in range(nr_jokes))
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False)
+    joke_id = db.Column(db.Integer, nullable=False)
+    rating = db.Column(db.Float, nullable=False)
 
+    def __repr__(self):
+        return '<Logged rating {:.3f} for joke {:d} from user {:d}>'.format(
+            self.rating,
+            self.joke_id,
+            self.user_id,
+        )
+
+
+class RatingLogReader(db.Model):  # type: ignore
+    "How far a process applied the rating log, and when it last reported it"
 
-def get_ratings(data):
-    return (Rating(user_id=int(user_id), joke_id=int(joke_id), rating=rating)
-            for user_id, joke_id, rating in data)
+    __tablename__ = 'rating_log_readers'
+
+    id = db.Column(db.String(80), primary_key=True)
+    last_id = db.Column(db.Integer, nullable=False)
+    updated_at = db.Column(db.Float, nullable=False)
+
+    def __repr__(self):
+        return '<Reader {:s} of the rating log at {:d}>'.format(self.id, self.last_id)
+
+
+# The ratings are loaded in double precision, as in the database, unlike
+# the snapshots of `giggle.data`
+DATABASE_RATINGS_DTYPES = (
+    ('user_id', np.int64),
+    ('joke_id', np.int64),
+    ('rating', np.float64),
+)
+
+# Number of first names (per gender) and of last names drawn from `names`,
+# which reads its files for every name; the full names combine them
+NAME_POOL_SIZE = 500
+
+
+def get_full_names(nr_names: int) -> List[str]:
+    pool = lambda get_name: np.array([get_name() for _ in range(min(nr_names, NAME_POOL_SIZE))])
+    is_male = np.random.rand(nr_names) < 0.5
+    first_names = np.where(
+        is_male,
+        np.random.choice(pool(lambda: names.get_first_name(gender='male')), nr_names),
+        np.random.choice(pool(lambda: names.get_first_name(gender='female')), nr_names),
+    )
+    last_names = np.random.choice(pool(names.get_last_name), nr_names)
+    return [' '.join(full_name) for full_name in zip(first_names, last_names)]
+
+
+def get_users(nr_users):
+    # The identifiers are those of the ratings
+    return ({'id': i, 'name': name} for i, name in enumerate(get_full_names(nr_users), 1))
+
+
+def get_jokes(nr_jokes):
+    return ({'id': i} for i in range(1, nr_jokes + 1))
+
+
+def validate_ratings(chunk: DataFrame):
+    # Vectorized version of `Rating.validate_rating`
+    is_invalid = ~chunk.rating.between(-10, 10)
+    if is_invalid.any():
+        message = "Rating should be between -10 and 10, but it is {:.3f}"
+        raise ValueError(message.format(chunk.rating[is_invalid].iloc[0]))
+
+
+def copy_ratings(connection, chunks: Iterable[DataFrame]) -> int:
+    # Postgres: streams the ratings through `COPY FROM STDIN`
+    nr_rows = 0
+    cursor = connection.connection.cursor()
+    for chunk in chunks:
+        buffer = StringIO()
+        chunk.to_csv(buffer, index=False, header=False)
+        buffer.seek(0)
+        cursor.copy_expert('COPY ratings (user_id, joke_id, rating) FROM STDIN WITH (FORMAT csv)', buffer)
+        nr_rows += len(chunk)
+    return nr_rows
+
+
+def insert_ratings(connection, chunks: Iterable[DataFrame]) -> int:
+    # Other databases: one `executemany` per chunk
+    nr_rows = 0
+    for chunk in chunks:
+        rows = zip(chunk.user_id.tolist(), chunk.joke_id.tolist(), chunk.rating.tolist())
+        connection.execute(Rating.__table__.insert(), [
+            {'user_id': user_id, 'joke_id': joke_id, 'rating': rating}
+            for user_id, joke_id, rating in rows
+        ])
+        nr_rows += len(chunk)
+    return nr_rows
+
+
+# Inserts a rating or, if the user already rated the joke, replaces it
+UPSERT_RATING = {
+    'mysql': (
+        'INSERT INTO ratings (user_id, joke_id, rating) VALUES (:user_id, :joke_id, :rating) '
+        'ON DUPLICATE KEY UPDATE rating = VALUES(rating)'
+    ),
+    # Postgres and SQLite (from version 3.24)
+    'default': (
+        'INSERT INTO ratings (user_id, joke_id, rating) VALUES (:user_id, :joke_id, :rating) '
+        'ON CONFLICT (user_id, joke_id) DO UPDATE SET rating = excluded.rating'
+    ),
+}  # type: Dict[str, str]
+
+
+def upsert_ratings(connection, rows: List[Tuple[int, int, float]]) -> int:
+    # A single `executemany`; the last rating of a (user, joke) pair wins
+    statement = UPSERT_RATING.get(connection.engine.dialect.name, UPSERT_RATING['default'])
+    connection.execute(text(statement), [
+        {'user_id': user_id, 'joke_id': joke_id, 'rating': rating}
+        for user_id, joke_id, rating in rows
+    ])
+    return len(rows)
+
+
+def log_ratings(connection, rows: List[Tuple[int, int, float]]) -> int:
+    # To be called in the transaction that writes the ratings
+    connection.execute(RatingLog.__table__.insert(), [
+        {'user_id': user_id, 'joke_id': joke_id, 'rating': rating}
+        for user_id, joke_id, rating in rows
+    ])
+    return len(rows)
+
+
+def trim_rating_log(connection, reader: str, last_id: int, max_age: float) -> int:
+    # Records that `reader` applied the log up to `last_id`, forgets the
+    # readers that did not report for `max_age` seconds (e.g. stopped
+    # processes) and deletes the rows that all the others applied
+    now = time.time()
+    params = {'id': reader, 'last_id': last_id, 'updated_at': now, 'min_updated_at': now - max_age}
+    connection.execute(text('DELETE FROM rating_log_readers WHERE id = :id'), params)
+    connection.execute(text('INSERT INTO rating_log_readers (id, last_id, updated_at) VALUES (:id, :last_id, :updated_at)'), params)
+    connection.execute(text('DELETE FROM rating_log_readers WHERE updated_at < :min_updated_at'), params)
+    result = connection.execute(text('DELETE FROM rating_log WHERE id <= (SELECT MIN(last_id) FROM rating_log_readers)'))
+    return result.rowcount
+
+
+def reset_sequence(connection, table: str):
+    # Postgres: the rows were inserted with their identifiers, so the next
+    # identifier of the serial column is set after the largest one
+    connection.execute(text(
+        "SELECT setval(pg_get_serial_sequence('{0}', 'id'), COALESCE(MAX(id), 1), MAX(id) IS NOT NULL) FROM {0}".format(table)
+    ))
+
+
+def report(table: str, nr_rows: int, start: float):
+    duration = time.time() - start
+    print('{:10s} {:9d} rows {:7.1f}s {:9.0f} rows/s'.format(table, nr_rows, duration, nr_rows / duration))
+
+
+def bulk_load(engine, path: str):
+    # The ratings file is read twice in chunks: first, to validate the
+    # ratings and find the number of users and jokes; then, to insert the
+    # ratings. Each table is filled in a single transaction.
+    nr_users = 0
+    nr_jokes = 0
+    for chunk in read_ratings_file(path, DATABASE_RATINGS_DTYPES):
+        validate_ratings(chunk)
+        nr_users = max(nr_users, int(chunk.user_id.max()))
+        nr_jokes = max(nr_jokes, int(chunk.joke_id.max()))
+
+    for table, nr_rows, rows in (('users', nr_users, get_users(nr_users)), ('jokes', nr_jokes, get_jokes(nr_jokes))):
+        start = time.time()
+        with engine.begin() as connection:
+            for group in grouper(rows, 10000):
+                connection.execute(db.metadata.tables[table].insert(), [row for row in group if row is not None])
+            if engine.dialect.name == 'postgresql':
+                reset_sequence(connection, table)
+        report(table, nr_rows, start)
+
+    start = time.time()
+    load_ratings = copy_ratings if engine.dialect.name == 'postgresql' else insert_ratings
+    with engine.begin() as connection:
+        nr_rows = load_ratings(connection, read_ratings_file(path, DATABASE_RATINGS_DTYPES))
+    report('ratings', nr_rows, start)
 
 
 def main():
@@ -102,38 +288,25 @@ def main():
         nargs='+',
         choices=('init', 'drop'),
         help="what operation to perform.")
+    parser.add_argument(
+        '-p', '--path',
+        default=RATINGS_PATH,
+        help="file with the ratings, one triplet (user, joke, rating) per line.")
     args = parser.parse_args()
 
+    # Imported here, since the configuration requires the environment
+    # variables of the web service
+    from .config import Config
+
     app = Flask(__name__)
     app.config.from_object(Config)
     db.init_app(app)
 
     if 'init' in args.todo:
 
-        data = np.loadtxt('data/jester/jester_ratings.dat')
-        nr_users = int(np.max(data[:, 0]))
-        nr_jokes = int(np.max(data[:, 1]))
-
-        def get_objects(table):
-            if table == 'users':
-                return get_users(nr_users)
-            elif table == 'jokes':
-                return get_jokes(nr_jokes)
-            elif table == 'ratings':
-                return get_ratings(data)
-            else:
-                assert False, "Unknown table {:s}".format(table)
-
-        my_grouper = partial(grouper, n=10000)
-
         with app.app_context():
             db.create_all()
-
-            for table in ('users', 'jokes', 'ratings'):
-                for objects in my_grouper(get_objects(table)):
-                    objects = [obj for obj in objects if obj is not None]
-                    db.session.bulk_save_objects(objects)
-                    db.session.commit()
+            bulk_load(db.engine, args.path)
 
     if 'drop' in args.todo:
 
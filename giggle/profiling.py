@@ -0,0 +1,107 @@
+import os
+import pdb
+import sys
+import threading
+import time
+
+from collections import (
+    Counter,
+    OrderedDict,
+)
+
+from contextlib import contextmanager
+
+from typing import (
+    Dict,
+    List,
+    Tuple,
+)
+
+
+# Total duration and number of calls of each phase, keyed by the path of
+# nested phases, e.g. `train/similarity`; the overhead is that of two calls
+# to `time.time`, so the phases are always recorded
+PHASES = OrderedDict()  # type: OrderedDict[str, List[float]]
+_local = threading.local()
+
+
+@contextmanager
+def phase(name: str):
+    stack = getattr(_local, 'stack', [])
+    _local.stack = stack
+    stack.append(name)
+    key = '/'.join(stack)
+    start = time.time()
+    try:
+        yield
+    finally:
+        stack.pop()
+        record(key, time.time() - start)
+
+
+def record(key: str, seconds: float, nr_calls: int=1):
+    total = PHASES.setdefault(key, [0.0, 0])
+    total[0] += seconds
+    total[1] += nr_calls
+
+
+def print_phases(wall: float):
+    print('{:32s} {:>7s} {:>10s} {:>6s}'.format('phase', 'calls', 'seconds', '%'))
+    for key, (seconds, nr_calls) in PHASES.items():
+        print('{:32s} {:7d} {:10.3f} {:6.1f}'.format(key, nr_calls, seconds, 100 * seconds / wall))
+
+
+def frame_label(code) -> str:
+    return '{} ({}:{:d})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+class SamplingProfiler:
+    "Samples the call stack of a thread at a fixed interval"
+
+    def __init__(self, interval: float=0.005) -> None:
+        self.interval = interval
+        self.stacks = Counter()  # type: Dict[Tuple[str, ...], int]
+        self._stop = threading.Event()
+        self._thread = None  # type: threading.Thread
+
+    # Same interface as `cProfile.Profile`
+
+    def enable(self):
+        # Samples the calling thread
+        self._target = threading.get_ident()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def disable(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            stack = []
+            while frame is not None:
+                stack.append(frame_label(frame.f_code))
+                frame = frame.f_back
+            if stack:
+                self.stacks[tuple(reversed(stack))] += 1
+
+    def write_collapsed(self, path: str):
+        # One line per stack, in the input format of `flamegraph.pl`
+        with open(path, 'w') as f:
+            for stack, nr_samples in self.stacks.most_common():
+                f.write('{} {:d}\n'.format(';'.join(stack), nr_samples))
+
+    def print_top(self, n: int):
+        # Self samples are those with the function at the top of the stack
+        nr_samples = sum(self.stacks.values()) or 1
+        own = Counter()  # type: Dict[str, int]
+        total = Counter()  # type: Dict[str, int]
+        for stack, count in self.stacks.items():
+            own[stack[-1]] += count
+            for label in set(stack):
+                total[label] += count
+        print('{:>7s} {:>7s}  {}'.format('self %', 'total %', 'function'))
+        for label, count in own.most_common(n):
+            print('{:7.1f} {:7.1f}  {}'.format(100 * count / nr_samples, 100 * total[label] / nr_samples, label))
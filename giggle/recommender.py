@@ -1,10 +1,20 @@
+import json
+import os
 import pdb
-import pickle
 
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from itertools import count
+
+from multiprocessing import cpu_count
 
 import numpy as np  # type: ignore
 
+from scipy.sparse import (  # type: ignore
+    coo_matrix,
+    csr_matrix,
+)
+
 from scipy.stats import (  # type: ignore
     beta,
     norm,
@@ -18,14 +28,32 @@ from pandas import (
 
 from typing import (
     Any,
+    Dict,
     Iterable,
     List,
+    Optional,
     Tuple,
 )
 
 from .data import (
     Data,
-    data_to_user_joke_matrix,
+    data_to_iids,
+    ids_to_iids,
+    iids_to_ids,
+    data_to_sparse_user_joke_matrix,
+    sparse_to_rated_matrix,
+)
+
+from .profiling import phase
+
+from .utils import ReadWriteLock
+
+from .similarity import (
+    DEFAULT_MAX_MEMORY,
+    build_similarities,
+    pearson,
+    pearson_similarities,
+    top_n,
 )
 
 
@@ -33,8 +61,45 @@ def rmse(y_true, y_pred):
     return np.sqrt(mean_squared_error(y_true, y_pred))
 
 
+NR_SIMILAR_JOKES = 20
+
+# The ratings of new (user, joke) pairs are buffered and merged into the
+# user-joke matrix once there are this many, since inserting them one by one
+# would copy the whole matrix each time
+MAX_NEW_RATINGS = 10000
+
+
+def top_similar_jokes(sims: np.array, iids: np.array, n: int) -> Tuple[np.array, np.array]:
+    # The `n` most similar jokes (their indices and similarities) to the
+    # jokes `iids`, whose similarities to all the jokes are the rows of `sims`
+    nr_rows, nr_jokes = sims.shape
+    rows = np.arange(nr_rows)[:, np.newaxis]
+    sims = np.array(sims, dtype=np.float64)
+    sims[rows[:, 0], iids] = -np.inf
+    top = top_n(sims, min(n, nr_jokes - 1))
+    return top, sims[rows, top]
+
+
+def top_jokes(scores: np.array, n: int, jokes: np.array) -> List[List[int]]:
+    # The excluded jokes have a score of minus infinity
+    top = top_n(scores, n)
+    is_valid = scores[np.arange(len(scores))[:, np.newaxis], top] > -np.inf
+    return [jokes[top_user[is_valid_user]].tolist() for top_user, is_valid_user in zip(top, is_valid)]
+
+
+def cosine_similarities(vectors: np.array) -> np.array:
+    norms = np.linalg.norm(vectors, axis=1)
+    vectors = vectors / np.maximum(norms, np.finfo(np.float64).tiny)[:, np.newaxis]
+    return vectors.dot(vectors.T)
+
+
 class Recommender:
 
+    # Names of the constructor arguments and of the fitted attributes; these
+    # are what `save_recommender` stores.
+    PARAMS = ()  # type: Tuple[str, ...]
+    STATE = ()  # type: Tuple[str, ...]
+
     def fit(self, data: Data, verbose: int):
         pass
 
@@ -47,13 +112,51 @@ class Recommender:
             for user_id, joke_id in user_joke_ids
         ]
 
+    def update(self, user_id: int, joke_id: int, rating: float):
+        # Incorporates a new (or changed) rating without re-fitting
+        pass
+
+    def _get_rated(self, user_ids: np.array) -> np.array:
+        # The jokes rated by the users, for the recommenders that keep the
+        # ratings; the others cannot tell which jokes to exclude
+        raise ValueError('{:s} does not keep the ratings, the rated jokes must be given'.format(type(self).__name__))
+
+    def _get_rated_mask(self, user_ids: np.array, rated: Optional[List[List[int]]]) -> np.array:
+        # Boolean mask over the jokes of the recommender; `rated` holds the
+        # identifiers of the jokes rated by each user
+        if rated is None:
+            return self._get_rated(user_ids)
+        joke_ids = np.concatenate([np.zeros(0, dtype=np.int64)] + [np.asarray(ids, dtype=np.int64) for ids in rated])
+        rows = np.repeat(np.arange(len(rated)), [len(ids) for ids in rated])
+        cols = ids_to_iids(joke_ids, self.joke_to_iid)
+        is_rated = np.zeros((len(rated), len(self.joke_to_iid)), dtype=bool)
+        is_rated[rows[cols >= 0], cols[cols >= 0]] = True
+        return is_rated
+
+    def recommend(self, user_ids: List[int], n: int, exclude_rated: bool=True, rated: List[List[int]]=None) -> List[List[int]]:
+        # The `n` jokes with the highest predicted ratings for each user; the
+        # rated jokes are those in `rated` or, if not given, those the
+        # recommender was trained or updated on, if it keeps the ratings
+        user_ids = np.asarray(user_ids, dtype=np.int64)
+        jokes = iids_to_ids(self.joke_to_iid)
+        is_candidate = np.ones((len(user_ids), len(jokes)), dtype=bool)
+        if exclude_rated:
+            is_candidate &= ~self._get_rated_mask(user_ids, rated)
+        rows, cols = np.nonzero(is_candidate)
+        scores = np.full(is_candidate.shape, -np.inf)
+        scores[rows, cols] = self.predict_multi(np.column_stack((user_ids[rows], jokes[cols])))
+        return top_jokes(scores, n, jokes)
+
 
 class GaussianRecommender(Recommender):
 
+    STATE = ('random_state', 'mu', 'sigma', 'joke_to_iid')
+
     def __init__(self):
         self.random_state = 1337
 
     def fit(self, data: Data, verbose: int):
+        self.joke_to_iid = dict(data.joke_to_iid)
         self.mu = data.data_frame.rating.mean()
         self.sigma = data.data_frame.rating.std()
         return self
@@ -79,10 +182,13 @@ class GaussianRecommender(Recommender):
 
 class BetaRecommender(Recommender):
 
+    STATE = ('random_state', 'a', 'b', 'loc', 'scale', 'joke_to_iid')
+
     def __init__(self):
         self.random_state = 1337
 
     def fit(self, data: Data, verbose: int):
+        self.joke_to_iid = dict(data.joke_to_iid)
         eps = 10 ** -1
         min_rating = data.data_frame.rating.min() - eps
         max_rating = data.data_frame.rating.max() + eps
@@ -122,97 +228,567 @@ class BetaRecommender(Recommender):
 
 class BaselineRecommender(Recommender):
 
-    def __init__(self, nr_epochs, lr, reg):
+    PARAMS = ('nr_epochs', 'lr', 'reg', 'solver', 'batch_size')
+    STATE = ('mu', 'b_user', 'b_joke', 'user_to_iid', 'joke_to_iid')
+
+    def __init__(self, nr_epochs, lr, reg, solver='als', batch_size=10000):
         self.nr_epochs = nr_epochs
         self.reg = reg
         self.lr = lr
+        self.solver = solver
+        self.batch_size = batch_size
         self.mu = None
         self.b_user = None
         self.b_joke = None
+        # As for `Neighbourhood`, the updates exclude the predictions
+        self.lock = ReadWriteLock()
 
     def _compute_rmse(self, data_frame: DataFrame) -> float:
-        true = data_frame.rating
-        pred = [self.predict(u, j) for _, u, j, _ in data_frame.itertuples()]
+        true = data_frame.rating.values
+        pred = self.predict_multi(data_frame[['user_id', 'joke_id']].values)
         return rmse(true, pred)
 
+    def _update_params_als(self, user_iids: np.array, joke_iids: np.array, ratings: np.array):
+        # Closed-form updates of one type of biases while keeping the other
+        # fixed; these are the fixed points of the stochastic updates below.
+        nr_users = len(self.b_user)
+        nr_jokes = len(self.b_joke)
+        denom_user = (1 + self.reg) * np.maximum(np.bincount(user_iids, minlength=nr_users), 1)
+        denom_joke = (1 + self.reg) * np.maximum(np.bincount(joke_iids, minlength=nr_jokes), 1)
+        resid = ratings - self.mu - self.b_joke[joke_iids]
+        self.b_user = np.bincount(user_iids, resid, minlength=nr_users) / denom_user
+        resid = ratings - self.mu - self.b_user[user_iids]
+        self.b_joke = np.bincount(joke_iids, resid, minlength=nr_jokes) / denom_joke
+
+    def _update_params_sgd(self, user_iids: np.array, joke_iids: np.array, ratings: np.array):
+        # Mini-batch gradient steps; the gradient of each bias is averaged
+        # over its ratings in the batch, so that the step does not grow with
+        # the number of ratings (e.g. of the popular jokes)
+        nr_users = len(self.b_user)
+        nr_jokes = len(self.b_joke)
+        idxs = self.random_state.permutation(len(ratings))
+        for start in range(0, len(idxs), self.batch_size):
+            batch = idxs[start: start + self.batch_size]
+            u = user_iids[batch]
+            j = joke_iids[batch]
+            err = ratings[batch] - (self.mu + self.b_user[u] + self.b_joke[j])
+            count_user = np.bincount(u, minlength=nr_users)
+            count_joke = np.bincount(j, minlength=nr_jokes)
+            grad_user = np.bincount(u, err, minlength=nr_users) / np.maximum(count_user, 1)
+            grad_user -= self.reg * (count_user > 0) * self.b_user
+            grad_joke = np.bincount(j, err, minlength=nr_jokes) / np.maximum(count_joke, 1)
+            grad_joke -= self.reg * (count_joke > 0) * self.b_joke
+            self.b_user += self.lr * grad_user
+            self.b_joke += self.lr * grad_joke
+
     def _update_params(self, data: Data) -> Iterable[None]:
-        self.b_user = defaultdict(int)
-        self.b_joke = defaultdict(int)
+        # Yields after each epoch over the data
+        self.user_to_iid = dict(data.user_to_iid)
+        self.joke_to_iid = dict(data.joke_to_iid)
+        self.b_user = np.zeros(len(data.users))
+        self.b_joke = np.zeros(len(data.jokes))
+        self.random_state = np.random.RandomState(1337)
+        user_iids, joke_iids = data_to_iids(data)
+        ratings = data.data_frame.rating.values
+        update_params = {
+            'als': self._update_params_als,
+            'sgd': self._update_params_sgd,
+        }[self.solver]
         for e in range(self.nr_epochs):
-            for _, u, j, r in data.data_frame.itertuples():
-                err = r - (self.mu + self.b_user[u] + self.b_joke[j])
-                self.b_user[u] += self.lr * (err - self.reg * self.b_user[u])
-                self.b_joke[j] += self.lr * (err - self.reg * self.b_joke[j])
-                yield
+            update_params(user_iids, joke_iids, ratings)
+            yield
 
     def fit(self, data: Data, verbose: int) -> Recommender:
         self.mu = data.data_frame.rating.mean()
+        self.ranking_ = None
         prev_rmse = np.inf
-        TO_CHECK_PERIOD = 10000
         STOP_TOL = 1e-4
-        for nr_iter, _ in enumerate(self._update_params(data)):
-            if nr_iter % TO_CHECK_PERIOD == 0:
+        with phase('epochs'):
+            for nr_iter, _ in enumerate(self._update_params(data)):
                 curr_rmse = self._compute_rmse(data.data_frame)
                 if verbose:
-                    print('{:5.0f} {:.2f}'.format(nr_iter / TO_CHECK_PERIOD, curr_rmse))
+                    print('{:5d} {:.4f}'.format(nr_iter, curr_rmse))
                 if np.abs(curr_rmse - prev_rmse) / curr_rmse < STOP_TOL:
                     break
                 else:
                     prev_rmse = curr_rmse
         return self
 
+    def update(self, user_id: int, joke_id: int, rating: float):
+        # One stochastic gradient step on the biases of the new rating; the
+        # biases of a new user or joke exist before its index is published
+        with self.lock.writing():
+            if user_id not in self.user_to_iid:
+                self.b_user = np.append(self.b_user, 0)
+                self.user_to_iid[user_id] = len(self.b_user) - 1
+            if joke_id not in self.joke_to_iid:
+                self.b_joke = np.append(self.b_joke, 0)
+                self.joke_to_iid[joke_id] = len(self.b_joke) - 1
+            u = self.user_to_iid[user_id]
+            j = self.joke_to_iid[joke_id]
+            err = rating - (self.mu + self.b_user[u] + self.b_joke[j])
+            self.b_user[u] += self.lr * (err - self.reg * self.b_user[u])
+            self.b_joke[j] += self.lr * (err - self.reg * self.b_joke[j])
+            self.ranking_ = None
+
+    def recommend(self, user_ids: List[int], n: int, exclude_rated: bool=True, rated: List[List[int]]=None) -> List[List[int]]:
+        # The user bias does not change the order of the jokes, so all the
+        # users share the ranking of the jokes by bias, which is kept until
+        # the next update; each user gets its first `n` unrated jokes
+        with self.lock.reading():
+            ranking = getattr(self, 'ranking_', None)
+            if ranking is None:
+                ranking = self.ranking_ = np.argsort(-self.b_joke, kind='mergesort')
+            jokes = iids_to_ids(self.joke_to_iid)[ranking]
+            if not exclude_rated:
+                return [jokes[:n].tolist() for _ in user_ids]
+            is_unrated = ~self._get_rated_mask(np.asarray(user_ids, dtype=np.int64), rated)[:, ranking]
+        is_top = is_unrated & (np.cumsum(is_unrated, axis=1) <= n)
+        return [jokes[is_top_user].tolist() for is_top_user in is_top]
+
     def predict(self, user_id: int, joke_id: int) -> float:
-        return self.mu + self.b_user[user_id] + self.b_joke[joke_id]
+        value, = self.predict_multi([(user_id, joke_id)])
+        return value
+
+    def predict_multi(self, user_joke_ids: List[Tuple[int, int]]) -> List[float]:
+        # Unknown users or jokes have a zero bias
+        user_joke_ids = np.asarray(user_joke_ids).reshape(-1, 2)
+        with self.lock.reading():
+            user_iids = ids_to_iids(user_joke_ids[:, 0], self.user_to_iid)
+            joke_iids = ids_to_iids(user_joke_ids[:, 1], self.joke_to_iid)
+            b_user = np.where(user_iids >= 0, self.b_user[user_iids], 0)
+            b_joke = np.where(joke_iids >= 0, self.b_joke[joke_iids], 0)
+        return self.mu + b_user + b_joke
 
 
 class Neighbourhood(Recommender):
 
-    def __init__(self, k: int) -> None:
+    # The neighbours of each joke, sorted by decreasing similarity, are the
+    # rows of `neighbours` (their indices) and `neighbour_sims`, with the same
+    # number of neighbours per joke: all the other jokes or, if
+    # `nr_neighbours` is given, only the most similar ones. In the latter
+    # case, the dense similarities and their statistics are not kept, so the
+    # memory is linear in the number of jokes. The top neighbours are
+    # computed for blocks of jokes of at most `max_memory` bytes, in parallel
+    # over `nr_jobs` processes.
+    PARAMS = ('k', 'nr_neighbours', 'max_memory', 'nr_jobs')
+    STATE = (
+        'mu',
+        'user_joke_matrix',
+        'statistics',
+        'sims',
+        'neighbours',
+        'neighbour_sims',
+        'similar_jokes',
+        'similar_sims',
+        'user_to_iid',
+        'joke_to_iid',
+    )
+
+    def __init__(self, k: int, nr_neighbours: int=None, max_memory: int=DEFAULT_MAX_MEMORY, nr_jobs: int=1) -> None:
+        # With `nr_neighbours`, the similarities are not updated with the
+        # ratings (only refitting refreshes them): the statistics they would
+        # be updated from are not kept
         self.k = k
+        self.nr_neighbours = nr_neighbours
+        self.max_memory = max_memory
+        self.nr_jobs = nr_jobs
+        # The updates exclude the predictions, which read the state they change
+        self.lock = ReadWriteLock()
+        self.new_ratings = {}  # type: Dict[int, Dict[int, float]]
+        self.nr_new_ratings = 0
+
+    def _compute_statistics(self, user_joke_matrix: csr_matrix) -> np.array:
+        # All the pairwise statistics are obtained as masked matrix products:
+        # the entry (i, j) sums over the users that rated both jokes i and j.
+        rated = sparse_to_rated_matrix(user_joke_matrix)
+        ratings = user_joke_matrix
+        support = rated.T.dot(rated).toarray()
+        sums = ratings.T.dot(rated).toarray()
+        sums_sq = ratings.multiply(ratings).T.dot(rated).toarray()
+        prods = ratings.T.dot(ratings).toarray()
+        return np.stack((support, sums, sums_sq, prods))
+
+    def _compute_similarities(self, user_joke_matrix: csr_matrix) -> np.array:
+        return pearson_similarities(*self._compute_statistics(user_joke_matrix))
+
+    def _rank_neighbours(self, sims: np.array, iids: np.array) -> Tuple[np.array, np.array]:
+        # For the jokes `iids`, whose similarities are given by the rows of
+        # `sims`, the other jokes sorted by decreasing similarity
+        nr_rows, nr_jokes = sims.shape
+        order = np.argsort(-sims, axis=1, kind='mergesort')
+        is_other = order != iids[:, np.newaxis]
+        neighbours = order[is_other].reshape(nr_rows, nr_jokes - 1)
+        neighbour_sims = sims[np.arange(nr_rows)[:, np.newaxis], neighbours]
+        return neighbours, neighbour_sims
+
+    def _set_similar_jokes(self, iids: np.array):
+        # The table of similar jokes is the beginning of the rankings
+        jokes = iids_to_ids(self.joke_to_iid)
+        self.similar_jokes[iids] = jokes[self.neighbours[iids, :NR_SIMILAR_JOKES]]
+        self.similar_sims[iids] = self.neighbour_sims[iids, :NR_SIMILAR_JOKES]
+
+    def _set_neighbours(self, neighbours: np.array, neighbour_sims: np.array):
+        nr_jokes, nr_neighbours = neighbours.shape
+        self.neighbours = neighbours
+        self.neighbour_sims = neighbour_sims
+        nr_similar = min(NR_SIMILAR_JOKES, nr_neighbours)
+        self.similar_jokes = np.zeros((nr_jokes, nr_similar), dtype=np.int64)
+        self.similar_sims = np.zeros((nr_jokes, nr_similar))
+        self._set_similar_jokes(np.arange(nr_jokes))
+
+    def _rank_all_neighbours(self):
+        nr_jokes = len(self.sims)
+        self._set_neighbours(*self._rank_neighbours(self.sims, np.arange(nr_jokes)))
+
+    def fit(self, data: Data, verbose: int) -> Recommender:
+        self.user_to_iid = dict(data.user_to_iid)
+        self.joke_to_iid = dict(data.joke_to_iid)
+        self.new_ratings = {}
+        self.nr_new_ratings = 0
+        with phase('matrix'):
+            self.user_joke_matrix = data_to_sparse_user_joke_matrix(data)
+        with phase('similarity'):
+            if self.nr_neighbours:
+                self.statistics = None
+                self.sims = None
+                self._set_neighbours(*build_similarities(
+                    self.user_joke_matrix,
+                    self.nr_neighbours,
+                    max_memory=self.max_memory,
+                    nr_jobs=self.nr_jobs,
+                    verbose=verbose,
+                ))
+            else:
+                self.statistics = self._compute_statistics(self.user_joke_matrix)
+                self.sims = pearson_similarities(*self.statistics)
+                self._rank_all_neighbours()
+        self.mu = data.data_frame.rating.mean()
+        return self
+
+    def _add_user(self, user_id: int):
+        # Its row is added to the matrix with the buffered ratings
+        self.user_to_iid[user_id] = len(self.user_to_iid)
+
+    def _add_joke(self, joke_id: int):
+        # A new joke has no support, hence zero similarity with the others
+        nr_users, nr_jokes = self.user_joke_matrix.shape
+        self.joke_to_iid[joke_id] = nr_jokes
+        self.user_joke_matrix = csr_matrix(
+            (self.user_joke_matrix.data, self.user_joke_matrix.indices, self.user_joke_matrix.indptr),
+            shape=(nr_users, nr_jokes + 1),
+        )
+        if self.statistics is None:
+            # Its neighbours are arbitrary jokes, of zero similarity
+            neighbours = np.arange(self.neighbours.shape[1], dtype=self.neighbours.dtype)[np.newaxis]
+            self._set_neighbours(
+                np.vstack((self.neighbours, neighbours)),
+                np.vstack((self.neighbour_sims, np.zeros(neighbours.shape, dtype=self.neighbour_sims.dtype))),
+            )
+            return
+        self.statistics = np.pad(self.statistics, ((0, 0), (0, 1), (0, 1)), 'constant')
+        self.sims = np.pad(self.sims, (0, 1), 'constant')
+        self.sims[nr_jokes, nr_jokes] = 1
+        self._rank_all_neighbours()
+
+    def _update_statistics(self, j: int, r: float, others: np.array, r_others: np.array, sign: int):
+        # Adds (or removes) the contribution of a user that rated joke `j`
+        # with `r` and the jokes `others` with `r_others`
+        support, sums, sums_sq, prods = self.statistics
+        support[j, others] += sign
+        support[others, j] += sign
+        support[j, j] += sign
+        sums[j, others] += sign * r
+        sums[others, j] += sign * r_others
+        sums[j, j] += sign * r
+        sums_sq[j, others] += sign * r ** 2
+        sums_sq[others, j] += sign * r_others ** 2
+        sums_sq[j, j] += sign * r ** 2
+        prods[j, others] += sign * r * r_others
+        prods[others, j] += sign * r * r_others
+        prods[j, j] += sign * r ** 2
+
+    def _get_user_ratings(self, u: int) -> Tuple[np.array, np.array]:
+        # The jokes rated by a user and the ratings, buffered ones included
+        m = self.user_joke_matrix
+        rated = np.zeros(0, dtype=m.indices.dtype)
+        ratings = np.zeros(0, dtype=m.dtype)
+        if u < m.shape[0]:
+            start, end = m.indptr[u], m.indptr[u + 1]
+            rated, ratings = m.indices[start: end], m.data[start: end]
+        new_ratings = self.new_ratings.get(u, {})
+        return (
+            np.append(rated, np.fromiter(new_ratings.keys(), dtype=rated.dtype, count=len(new_ratings))),
+            np.append(ratings, np.fromiter(new_ratings.values(), dtype=ratings.dtype, count=len(new_ratings))),
+        )
+
+    def _get_user_rows(self, user_iids: np.array) -> Tuple[np.array, np.array]:
+        # Dense rows of the ratings of the users and of their indicators
+        m = self.user_joke_matrix
+        nr_users, _ = m.shape
+        is_known = user_iids < nr_users
+        rows = m[np.where(is_known, user_iids, 0)] if nr_users else csr_matrix((len(user_iids), m.shape[1]))
+        user_ratings = rows.toarray()
+        is_rated = sparse_to_rated_matrix(rows).toarray().astype(bool)
+        user_ratings[~is_known] = 0
+        is_rated[~is_known] = False
+        for i, u in enumerate(user_iids.tolist()):
+            new_ratings = self.new_ratings.get(u)
+            if new_ratings:
+                cols = list(new_ratings.keys())
+                user_ratings[i, cols] = list(new_ratings.values())
+                is_rated[i, cols] = True
+        return user_ratings, is_rated
+
+    def _set_rating(self, u: int, j: int, rating: float):
+        # Ratings already in the matrix are changed in place, the others are
+        # buffered until enough of them are merged at once
+        m = self.user_joke_matrix
+        if u < m.shape[0]:
+            start, end = m.indptr[u], m.indptr[u + 1]
+            i = start + np.searchsorted(m.indices[start: end], j)
+            if i < end and m.indices[i] == j:
+                m.data[i] = rating
+                return
+        new_ratings = self.new_ratings.setdefault(u, {})
+        if j not in new_ratings:
+            self.nr_new_ratings += 1
+        new_ratings[j] = rating
+        if self.nr_new_ratings >= MAX_NEW_RATINGS:
+            self._merge_new_ratings()
+
+    def _merge_new_ratings(self):
+        # As when fitting, the ratings of zero are kept as explicit entries
+        m = self.user_joke_matrix.tocoo()
+        new_ratings = self.new_ratings.values()
+        user_iids = np.repeat(
+            np.fromiter(self.new_ratings.keys(), dtype=np.int64, count=len(self.new_ratings)),
+            [len(ratings) for ratings in new_ratings],
+        )
+        joke_iids = [j for ratings in new_ratings for j in ratings.keys()]
+        ratings = [r for ratings in new_ratings for r in ratings.values()]
+        self.user_joke_matrix = coo_matrix(
+            (
+                np.append(m.data, ratings),
+                (np.append(m.row, user_iids), np.append(m.col, joke_iids)),
+            ),
+            shape=(len(self.user_to_iid), len(self.joke_to_iid)),
+        ).tocsr()
+        self.new_ratings = {}
+        self.nr_new_ratings = 0
+
+    def update(self, user_id: int, joke_id: int, rating: float):
+        # Updates the sufficient statistics for the pairs of jokes rated by the
+        # user, which requires O(J) operations, and then the similarities of
+        # the joke together with the rankings of the affected neighbours.
+        # With `nr_neighbours`, only the ratings are updated.
+        with self.lock.writing():
+            self._update(user_id, joke_id, rating)
+
+    def _update(self, user_id: int, joke_id: int, rating: float):
+        if user_id not in self.user_to_iid:
+            self._add_user(user_id)
+        if joke_id not in self.joke_to_iid:
+            self._add_joke(joke_id)
+        u = self.user_to_iid[user_id]
+        j = self.joke_to_iid[joke_id]
+        rated, ratings = self._get_user_ratings(u)
+        is_other = rated != j
+        others = rated[is_other]
+        r_others = ratings[is_other]
+        if self.statistics is not None and not np.all(is_other):
+            self._update_statistics(j, ratings[~is_other][0], others, r_others, sign=-1)
+        self._set_rating(u, j, rating)
+        if self.statistics is None:
+            return
+        self._update_statistics(j, rating, others, r_others, sign=+1)
+        support, sums, sums_sq, prods = self.statistics
+        sims = pearson(support[j], sums[j], sums[:, j], sums_sq[j], sums_sq[:, j], prods[j])
+        sims[j] = 1
+        self.sims[j] = sims
+        self.sims[:, j] = sims
+        iids = np.append(others, j)
+        self.neighbours[iids], self.neighbour_sims[iids] = self._rank_neighbours(self.sims[iids], iids)
+        self._set_similar_jokes(iids)
+
+    def _predict_batch(self, user_iids: np.array, joke_iids: np.array) -> np.array:
+        # Dense rows for the users in the batch
+        users, rows = np.unique(user_iids, return_inverse=True)
+        user_ratings, is_rated = self._get_user_rows(users)
+        # Select the k most similar jokes that were rated by the user
+        rows = rows[:, np.newaxis]
+        neighbours = self.neighbours[joke_iids]
+        selected = is_rated[rows, neighbours]
+        selected &= np.cumsum(selected, axis=1) <= self.k
+        sims = np.where(selected, self.neighbour_sims[joke_iids], 0)
+        sum_rat = np.sum(sims * user_ratings[rows, neighbours], axis=1)
+        sum_sim = np.sum(sims, axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(sum_sim != 0, sum_rat / sum_sim, self.mu)
+
+    def predict(self, user_id: int, joke_id: int) -> float:
+        value, = self.predict_multi([(user_id, joke_id)])
+        return value
 
-    def _compute_similarities(self, user_joke_matrix: np.array) -> np.array:
-        MIN_SUPPORT = 5
-        _, nr_jokes = user_joke_matrix.shape
-        joke_joke_matrix = np.zeros((nr_jokes, nr_jokes))
-        np.fill_diagonal(joke_joke_matrix, 1)
-        for i in range(nr_jokes):
-            for j in range(i + 1, nr_jokes):
-                common = np.logical_and(
-                    np.logical_not(np.isnan(user_joke_matrix[:, i])),
-                    np.logical_not(np.isnan(user_joke_matrix[:, j])),
-                )
-                if np.sum(common) < MIN_SUPPORT:
-                    continue
-                r_i = user_joke_matrix[common, i] - user_joke_matrix[common, i].mean()
-                r_j = user_joke_matrix[common, j] - user_joke_matrix[common, j].mean()
-                numer = np.sum(r_i * r_j)
-                denom = np.sqrt(np.sum(r_i ** 2)) * np.sqrt(np.sum(r_j ** 2))
-                joke_joke_matrix[i, j] = joke_joke_matrix[j, i] = numer / denom
-        return joke_joke_matrix
-
-    def _find_most_similar_rated_jokes(self, user_ratings: np.array, joke_id: int) -> List[int]:
-        i = self.data.joke_to_iid[joke_id]
-        rated_iids, = np.where(np.logical_not(np.isnan(user_ratings)))
-        joke_iids = np.argsort(-self.sims[i])
-        joke_iids = [iid for iid in joke_iids if iid != i and iid in rated_iids]
-        joke_iids = joke_iids[:self.k]
-        return joke_iids
+    def _predict_iids(self, user_iids: np.array, joke_iids: np.array) -> np.array:
+        # Pairs with unknown users or jokes are predicted as the mean rating
+        MAX_BATCH_ENTRIES = 2 ** 20
+        preds = np.full(len(user_iids), self.mu)
+        known, = np.where(np.logical_and(user_iids >= 0, joke_iids >= 0))
+        batch_size = max(1, MAX_BATCH_ENTRIES // max(1, self.neighbours.shape[1]))
+        for start in range(0, len(known), batch_size):
+            idxs = known[start: start + batch_size]
+            preds[idxs] = self._predict_batch(user_iids[idxs], joke_iids[idxs])
+        return preds
+
+    def predict_multi(self, user_joke_ids: List[Tuple[int, int]]) -> List[float]:
+        user_joke_ids = np.asarray(user_joke_ids).reshape(-1, 2)
+        with self.lock.reading():
+            user_iids = ids_to_iids(user_joke_ids[:, 0], self.user_to_iid)
+            joke_iids = ids_to_iids(user_joke_ids[:, 1], self.joke_to_iid)
+            return self._predict_iids(user_iids, joke_iids)
+
+    def _get_rated(self, user_ids: np.array) -> np.array:
+        user_iids = ids_to_iids(user_ids, self.user_to_iid)
+        _, is_rated = self._get_user_rows(np.maximum(user_iids, 0))
+        is_rated[user_iids < 0] = False
+        return is_rated
+
+    def recommend(self, user_ids: List[int], n: int, exclude_rated: bool=True, rated: List[List[int]]=None) -> List[List[int]]:
+        # Scores the candidate jokes of all the users at once, working with
+        # indices rather than identifiers
+        user_ids = np.asarray(user_ids, dtype=np.int64)
+        with self.lock.reading():
+            user_iids = ids_to_iids(user_ids, self.user_to_iid)
+            nr_jokes = len(self.joke_to_iid)
+            is_candidate = np.ones((len(user_ids), nr_jokes), dtype=bool)
+            if exclude_rated:
+                is_candidate &= ~self._get_rated_mask(user_ids, rated)
+            rows, cols = np.nonzero(is_candidate)
+            scores = np.full(is_candidate.shape, -np.inf)
+            scores[rows, cols] = self._predict_iids(user_iids[rows], cols)
+            jokes = iids_to_ids(self.joke_to_iid)
+        return top_jokes(scores, n, jokes)
+
+
+class MatrixFactorization(Recommender):
+
+    PARAMS = ('nr_factors', 'reg', 'nr_epochs', 'dtype', 'nr_jobs')
+    STATE = (
+        'mu',
+        'p_user',
+        'q_joke',
+        'b_user',
+        'b_joke',
+        'similar_jokes',
+        'similar_sims',
+        'user_to_iid',
+        'joke_to_iid',
+    )
+
+    def __init__(self, nr_factors: int, reg: float, nr_epochs: int, dtype: str='float64', nr_jobs: int=None) -> None:
+        self.nr_factors = nr_factors
+        self.reg = reg
+        self.nr_epochs = nr_epochs
+        self.dtype = dtype
+        self.nr_jobs = nr_jobs
+
+    def _solve_block(self, ratings: csr_matrix, features: np.array) -> np.array:
+        # Regularized least squares for each row of the block; the Gram
+        # matrices of all rows are obtained with a single sparse product.
+        nr_rows, _ = ratings.shape
+        _, dim = features.shape
+        rated = sparse_to_rated_matrix(ratings)
+        outer = features[:, :, np.newaxis] * features[:, np.newaxis, :]
+        gram = rated.dot(outer.reshape(-1, dim * dim)).reshape(nr_rows, dim, dim)
+        counts = np.maximum(np.diff(ratings.indptr), 1)
+        gram += self.reg * counts[:, np.newaxis, np.newaxis] * np.eye(dim)
+        rhs = ratings.dot(features)
+        return np.linalg.solve(gram, rhs[:, :, np.newaxis])[:, :, 0]
+
+    def _update_factors(self, ratings: csr_matrix, factors: np.array, biases: np.array) -> Tuple[np.array, np.array]:
+        # Solves for the factors and biases of the rows of `ratings` given the
+        # factors and biases of its columns: the biases are learnt as an
+        # extra factor that is paired with a constant feature.
+        nr_rows, _ = ratings.shape
+        resid = csr_matrix(
+            (ratings.data - self.mu - biases[ratings.indices], ratings.indices, ratings.indptr),
+            shape=ratings.shape,
+        )
+        features = np.hstack((factors, np.ones((len(factors), 1))))
+        block_size = int(np.ceil(nr_rows / self.nr_jobs_))
+        blocks = [slice(start, start + block_size) for start in range(0, nr_rows, block_size)]
+        with ThreadPoolExecutor(max_workers=self.nr_jobs_) as executor:
+            solutions = list(executor.map(lambda b: self._solve_block(resid[b], features), blocks))
+        solution = np.vstack(solutions)
+        return solution[:, :-1], solution[:, -1]
+
+    def _compute_rmse(self, user_joke_matrix: csr_matrix) -> float:
+        user_iids = np.repeat(np.arange(user_joke_matrix.shape[0]), np.diff(user_joke_matrix.indptr))
+        joke_iids = user_joke_matrix.indices
+        pred = (
+            self.mu + self.b_user[user_iids] + self.b_joke[joke_iids] +
+            np.sum(self.p_user[user_iids] * self.q_joke[joke_iids], axis=1)
+        )
+        return rmse(user_joke_matrix.data, pred)
 
     def fit(self, data: Data, verbose: int) -> Recommender:
-        self.user_joke_matrix = data_to_user_joke_matrix(data)
-        self.sims = self._compute_similarities(self.user_joke_matrix)
-        self.data = data
+        self.nr_jobs_ = self.nr_jobs or cpu_count()
+        self.user_to_iid = data.user_to_iid
+        self.joke_to_iid = data.joke_to_iid
         self.mu = data.data_frame.rating.mean()
+        with phase('matrix'):
+            user_joke_matrix = data_to_sparse_user_joke_matrix(data)
+            joke_user_matrix = user_joke_matrix.T.tocsr()
+        random_state = np.random.RandomState(1337)
+        self.p_user = 0.1 * random_state.randn(len(data.users), self.nr_factors)
+        self.q_joke = 0.1 * random_state.randn(len(data.jokes), self.nr_factors)
+        self.b_user = np.zeros(len(data.users))
+        self.b_joke = np.zeros(len(data.jokes))
+        with phase('epochs'):
+            for e in range(self.nr_epochs):
+                self.p_user, self.b_user = self._update_factors(user_joke_matrix, self.q_joke, self.b_joke)
+                self.q_joke, self.b_joke = self._update_factors(joke_user_matrix, self.p_user, self.b_user)
+                if verbose:
+                    print('{:5d} {:.4f}'.format(e, self._compute_rmse(user_joke_matrix)))
+        for attr in ('p_user', 'q_joke', 'b_user', 'b_joke'):
+            setattr(self, attr, getattr(self, attr).astype(self.dtype))
+        # Jokes are similar if their latent factors point in the same direction
+        with phase('similarity'):
+            iids = np.arange(len(self.q_joke))
+            top, self.similar_sims = top_similar_jokes(cosine_similarities(self.q_joke), iids, NR_SIMILAR_JOKES)
+            self.similar_jokes = iids_to_ids(self.joke_to_iid)[top]
         return self
 
     def predict(self, user_id: int, joke_id: int) -> float:
-        user_iid = self.data.user_to_iid[user_id]
-        joke_iid = self.data.joke_to_iid[joke_id]
-        user_ratings = self.user_joke_matrix[user_iid]
-        jokes = self._find_most_similar_rated_jokes(user_ratings, joke_id)
-        sum_rat = np.sum(self.sims[joke_iid, jokes] * user_ratings[jokes])
-        sum_sim = np.sum(self.sims[joke_iid, jokes])
-        return (sum_rat / sum_sim) if sum_sim != 0 else self.mu
+        value, = self.predict_multi([(user_id, joke_id)])
+        return value
+
+    def predict_multi(self, user_joke_ids: List[Tuple[int, int]]) -> List[float]:
+        # Unknown users or jokes have zero biases and factors
+        user_joke_ids = np.asarray(user_joke_ids).reshape(-1, 2)
+        user_iids = ids_to_iids(user_joke_ids[:, 0], self.user_to_iid)
+        joke_iids = ids_to_iids(user_joke_ids[:, 1], self.joke_to_iid)
+        is_user = user_iids >= 0
+        is_joke = joke_iids >= 0
+        b_user = np.where(is_user, self.b_user[user_iids], 0)
+        b_joke = np.where(is_joke, self.b_joke[joke_iids], 0)
+        dots = np.sum(self.p_user[user_iids] * self.q_joke[joke_iids], axis=1)
+        return self.mu + b_user + b_joke + np.where(is_user & is_joke, dots, 0)
+
+    def recommend(self, user_ids: List[int], n: int, exclude_rated: bool=True, rated: List[List[int]]=None) -> List[List[int]]:
+        # The scores of all the jokes are a single matrix product, of which
+        # only the top is sorted; the recommender does not keep the ratings,
+        # so the rated jokes have to be given in `rated`
+        user_ids = np.asarray(user_ids, dtype=np.int64)
+        user_iids = ids_to_iids(user_ids, self.user_to_iid)
+        is_user = (user_iids >= 0)[:, np.newaxis]
+        b_user = np.where(is_user[:, 0], self.b_user[user_iids], 0)
+        p_user = np.where(is_user, self.p_user[user_iids], 0)
+        scores = self.mu + b_user[:, np.newaxis] + self.b_joke + p_user.dot(self.q_joke.T)
+        if exclude_rated:
+            scores[self._get_rated_mask(user_ids, rated)] = -np.inf
+        return top_jokes(scores, n, iids_to_ids(self.joke_to_iid))
 
 
 RECOMMENDERS = {
@@ -220,21 +796,79 @@ RECOMMENDERS = {
     'beta': BetaRecommender(),
     'baseline': BaselineRecommender(nr_epochs=10, lr=0.01, reg=0.1),
     'neigh': Neighbourhood(k=35),
+    # Its similarities are only refreshed by fitting again
+    'neigh_sparse': Neighbourhood(k=35, nr_neighbours=100),
+    'mf': MatrixFactorization(nr_factors=10, reg=0.1, nr_epochs=10),
+    'mf_float32': MatrixFactorization(nr_factors=10, reg=0.1, nr_epochs=10, dtype='float32'),
     # 'neigh_mean': Neighbourhood(),
     # 'neigh_base': Neighbourhood(),
 }
 
 
+RECOMMENDER_TYPES = {
+    cls.__name__: cls
+    for cls in (
+        GaussianRecommender,
+        BetaRecommender,
+        BaselineRecommender,
+        Neighbourhood,
+        MatrixFactorization,
+    )
+}
+
+
 def get_recommender_path(key: str) -> str:
-    PATH = 'data/models/{}.pkl'
+    PATH = 'data/models/{}'
     return PATH.format(key)
 
 
 def save_recommender(path: str, recommender: Recommender):
-    with open(path, 'wb') as f:
-        pickle.dump(recommender, f)
+    # Stores a recommender as a folder with a description, `meta.json`, and
+    # one `.npy` file per array; sparse matrices are split in their arrays
+    # and the identifier maps are kept as the arrays of identifiers.
+    os.makedirs(path, exist_ok=True)
+    meta = {
+        'class': type(recommender).__name__,
+        'params': {name: getattr(recommender, name) for name in recommender.PARAMS},
+        'scalars': {},
+        'arrays': [],
+        'sparse': {},
+        'id_maps': [],
+    }  # type: Dict[str, Any]
+    save_array = lambda name, array: np.save(os.path.join(path, name + '.npy'), array)
+    for name in recommender.STATE:
+        value = getattr(recommender, name)
+        if isinstance(value, csr_matrix):
+            for attr in ('data', 'indices', 'indptr'):
+                save_array(name + '.' + attr, getattr(value, attr))
+            meta['sparse'][name] = value.shape
+        elif isinstance(value, dict):
+            save_array(name, iids_to_ids(value))
+            meta['id_maps'].append(name)
+        elif isinstance(value, np.ndarray):
+            save_array(name, value)
+            meta['arrays'].append(name)
+        else:
+            meta['scalars'][name] = value.item() if isinstance(value, np.generic) else value
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=4)
 
 
 def load_recommender(path: str) -> Recommender:
-    with open(path, 'rb') as f:
-        return pickle.load(f)
+    # The arrays are memory-mapped copy-on-write: processes loading the same
+    # model share its pages, while updates only change private copies.
+    with open(os.path.join(path, 'meta.json'), 'r') as f:
+        meta = json.load(f)
+    load_array = lambda name: np.load(os.path.join(path, name + '.npy'), mmap_mode='c')
+    recommender = RECOMMENDER_TYPES[meta['class']](**meta['params'])
+    for name, value in meta['scalars'].items():
+        setattr(recommender, name, value)
+    for name in meta['arrays']:
+        setattr(recommender, name, load_array(name))
+    for name, shape in meta['sparse'].items():
+        arrays = tuple(load_array(name + '.' + attr) for attr in ('data', 'indices', 'indptr'))
+        setattr(recommender, name, csr_matrix(arrays, shape=shape))
+    for name in meta['id_maps']:
+        ids = load_array(name)
+        setattr(recommender, name, dict(zip(ids.tolist(), count())))
+    return recommender
@@ -0,0 +1,155 @@
+import os
+import pdb
+import re
+import shutil
+import threading
+import time
+
+from typing import (
+    Callable,
+    List,
+    Optional,
+    Tuple,
+)
+
+from .recommender import (
+    Recommender,
+    get_recommender_path,
+    load_recommender,
+    save_recommender,
+)
+
+
+# The models of a recommender are kept in versions, `data/models/<key>/<version>/`,
+# and the file `data/models/<key>/CURRENT` names the version to serve. Models
+# saved before the registry, directly in `data/models/<key>/`, are loaded
+# when there is no `CURRENT` file.
+CURRENT = 'CURRENT'
+
+
+def get_version_path(key: str, version: str) -> str:
+    return os.path.join(get_recommender_path(key), version)
+
+
+# Default version names: the time of the save and, if needed, a suffix
+VERSION_PATTERN = re.compile(r'^(\d{8}-\d{6})(?:-(\d+))?$')
+
+
+def get_version_order(version: str) -> Tuple[str, int]:
+    # Sorts the default names by time and suffix, `-10` after `-9`, and the
+    # other names after them
+    match = VERSION_PATTERN.match(version)
+    if match is None:
+        return version, 0
+    timestamp, suffix = match.groups()
+    return timestamp, int(suffix or 0)
+
+
+def list_versions(key: str) -> List[str]:
+    # Oldest first
+    path = get_recommender_path(key)
+    if not os.path.isdir(path):
+        return []
+    return sorted((
+        version
+        for version in os.listdir(path)
+        if not version.startswith('.') and os.path.exists(os.path.join(path, version, 'meta.json'))
+    ), key=get_version_order)
+
+
+def get_current_version(key: str) -> Optional[str]:
+    try:
+        with open(os.path.join(get_recommender_path(key), CURRENT)) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def set_current_version(key: str, version: str):
+    # The pointer is replaced atomically, so readers see either version
+    if version not in list_versions(key):
+        raise ValueError("Unknown version {} of the model {}".format(version, key))
+    path = os.path.join(get_recommender_path(key), CURRENT)
+    tmp_path = '{}.{:d}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        f.write(version + '\n')
+    os.replace(tmp_path, path)
+
+
+def new_version(key: str) -> str:
+    version = time.strftime('%Y%m%d-%H%M%S')
+    versions = set(list_versions(key))
+    suffix = 1
+    while version in versions:
+        version = '{}-{:d}'.format(time.strftime('%Y%m%d-%H%M%S'), suffix)
+        suffix += 1
+    return version
+
+
+def save_version(key: str, recommender: Recommender, version: str=None, keep: int=None, promote: bool=False) -> str:
+    # Saves the model as a new version, which becomes the current one only
+    # with `promote`; the folder is renamed into place once complete, so
+    # that it is never seen half written. With `keep`, only the latest
+    # `keep` versions are kept.
+    version = version or new_version(key)
+    path = get_version_path(key, version)
+    if os.path.exists(path):
+        raise ValueError("Version {} of the model {} already exists".format(version, key))
+    tmp_path = get_version_path(key, '.{}.tmp'.format(version))
+    save_recommender(tmp_path, recommender)
+    os.rename(tmp_path, path)
+    if promote:
+        set_current_version(key, version)
+    if keep:
+        prune_versions(key, keep)
+    return version
+
+
+def prune_versions(key: str, keep: int):
+    # Removes the oldest versions, but never the current one; the processes
+    # serving a removed version keep its memory-mapped files open
+    current = get_current_version(key)
+    versions = list_versions(key)
+    for version in versions[:max(len(versions) - keep, 0)]:
+        if version != current:
+            shutil.rmtree(get_version_path(key, version), ignore_errors=True)
+
+
+def load_version(key: str, version: str=None) -> Tuple[Optional[str], Recommender]:
+    # The given version, or else the current one, or else the model saved
+    # without a version, in which case the version is None
+    version = version or get_current_version(key)
+    path = get_version_path(key, version) if version else get_recommender_path(key)
+    return version, load_recommender(path)
+
+
+class VersionWatcher:
+    "Calls a function with the new current version of a model when it changes"
+
+    def __init__(self, key: str, func: Callable[[str], None], interval: float=10.0) -> None:
+        self.key = key
+        self.func = func
+        self.interval = interval
+        self.version = get_current_version(key)
+        self._lock = threading.Lock()
+        self._pid = None  # type: int
+
+    def ensure_started(self):
+        # As for the micro-batcher, forked processes start their own thread
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            thread = threading.Thread(target=self._run, daemon=True)
+            thread.start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        # A version is passed once, even if `func` fails on it
+        while True:
+            time.sleep(self.interval)
+            version = get_current_version(self.key)
+            if version is not None and version != self.version:
+                self.version = version
+                self.func(version)
@@ -0,0 +1,231 @@
+import gc
+import logging
+import os
+import pdb
+import signal
+import socket
+import threading
+import time
+
+from werkzeug.serving import make_server  # type: ignore
+
+from typing import (
+    Callable,
+    Dict,
+    List,
+)
+
+
+# Workers that die sooner than this after their start are restarted with a
+# delay, to avoid a busy loop of crashes
+MIN_WORKER_LIFETIME = 1.0
+
+
+def memory_usage(pid: int) -> Dict[str, int]:
+    # Resident set size of a process and its proportional share (PSS), which
+    # splits the shared pages among the processes that map them, in bytes;
+    # read from `/proc`, so only on Linux
+    fields = {
+        'Rss': 'rss',
+        'Pss': 'pss',
+        'Shared_Clean': 'shared',
+        'Shared_Dirty': 'shared',
+        'Private_Clean': 'private',
+        'Private_Dirty': 'private',
+        'VmRSS': 'rss',
+    }
+    usage = {}  # type: Dict[str, int]
+    # `smaps_rollup` needs Linux 4.14, `status` only has the RSS
+    for name in ('smaps_rollup', 'status'):
+        try:
+            with open('/proc/{:d}/{}'.format(pid, name)) as f:
+                for line in f:
+                    field, _, value = line.partition(':')
+                    if field in fields and value.strip().endswith('kB'):
+                        key = fields[field]
+                        usage[key] = usage.get(key, 0) + 1024 * int(value.split()[0])
+        except (IOError, OSError):
+            continue
+        if usage:
+            break
+    return usage
+
+
+class PreforkServer:
+    "Serves a WSGI application from workers forked from the current process"
+
+    def __init__(
+            self,
+            app,
+            host: str,
+            port: int,
+            nr_workers: int,
+            before_fork: Callable[[], None]=None,
+            on_exit: Callable[[], None]=None,
+            graceful_timeout: float=30.0,
+            report_interval: float=0.0,
+            logger: logging.Logger=None) -> None:
+        # Everything loaded before `run`, such as the model, is shared by
+        # the workers copy-on-write. `before_fork` runs in this process
+        # before each fork, e.g. to close the database connections, and
+        # `on_exit` runs in each worker once it stopped serving.
+        self.app = app
+        self.host = host
+        self.port = port
+        self.nr_workers = nr_workers
+        self.before_fork = before_fork
+        self.on_exit = on_exit
+        self.graceful_timeout = graceful_timeout
+        self.report_interval = report_interval
+        self.logger = logger or logging.getLogger(__name__)
+        self.workers = {}  # type: Dict[int, float]
+        self._stopping = False
+        self._restarting = False
+        self._reporting = False
+
+    def run(self):
+        # The workers accept the connections on the socket of the master
+        address_family = socket.AF_INET6 if ':' in self.host else socket.AF_INET
+        self.socket = socket.socket(address_family, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((self.host, self.port))
+        self.socket.listen(128)
+        # Objects that exist before the fork are left alone by the garbage
+        # collector of the workers, which would otherwise copy their pages
+        if hasattr(gc, 'freeze'):
+            gc.collect()
+            gc.freeze()
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+        signal.signal(signal.SIGHUP, self._handle_restart)
+        signal.signal(signal.SIGUSR1, self._handle_report)
+        self.logger.info("Master {:d} listening on {}:{:d} with {:d} workers".format(os.getpid(), self.host, self.port, self.nr_workers))
+        for _ in range(self.nr_workers):
+            self._spawn()
+        next_report = time.time() + self.report_interval
+        try:
+            while not self._stopping:
+                self._reap()
+                if self._restarting:
+                    self._restarting = False
+                    self._restart_all()
+                if self._reporting or (self.report_interval and time.time() >= next_report):
+                    self._reporting = False
+                    next_report = time.time() + self.report_interval
+                    self.report_memory()
+                time.sleep(0.2)
+        finally:
+            self._stop(list(self.workers))
+            self.socket.close()
+        self.logger.info("Master {:d} stopped".format(os.getpid()))
+
+    def _handle_stop(self, signum, frame):
+        self._stopping = True
+
+    def _handle_restart(self, signum, frame):
+        self._restarting = True
+
+    def _handle_report(self, signum, frame):
+        self._reporting = True
+
+    def _spawn(self) -> int:
+        if self.before_fork:
+            self.before_fork()
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                self._serve()
+                status = 0
+            except Exception:
+                self.logger.exception("Worker {:d} failed".format(os.getpid()))
+            finally:
+                # Never return into the loop of the master
+                os._exit(status)
+        self.workers[pid] = time.time()
+        self.logger.info("Started worker {:d}".format(pid))
+        return pid
+
+    def _serve(self):
+        # Worker: the master handles the interrupts and restarts, a SIGTERM
+        # stops accepting connections and waits for the pending requests
+        for signum in (signal.SIGINT, signal.SIGHUP, signal.SIGUSR1):
+            signal.signal(signum, signal.SIG_IGN)
+        server = make_server(self.host, self.port, self.app, threaded=True, fd=self.socket.fileno())
+        server.daemon_threads = False
+        stop = lambda signum, frame: threading.Thread(target=server.shutdown).start()
+        signal.signal(signal.SIGTERM, stop)
+        server.serve_forever()
+        server.server_close()
+        if self.on_exit:
+            self.on_exit()
+
+    def _reap(self):
+        # Replaces the workers that died
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            start = self.workers.pop(pid, None)
+            if start is None or self._stopping:
+                continue
+            self.logger.warning("Worker {:d} exited with status {:d}, restarting it".format(pid, status))
+            if time.time() - start < MIN_WORKER_LIFETIME:
+                time.sleep(MIN_WORKER_LIFETIME)
+            self._spawn()
+
+    def _restart_all(self):
+        # One worker at a time, so that the others keep serving
+        for pid in list(self.workers):
+            self._spawn()
+            self._stop([pid])
+
+    def _stop(self, pids: List[int]):
+        # Sends a SIGTERM and, after the graceful timeout, a SIGKILL
+        for pid in pids:
+            self._kill(pid, signal.SIGTERM)
+        deadline = time.time() + self.graceful_timeout
+        pending = set(pids)
+        while pending:
+            for pid in list(pending):
+                try:
+                    is_done = os.waitpid(pid, os.WNOHANG)[0] == pid
+                except ChildProcessError:
+                    is_done = True
+                if is_done:
+                    pending.discard(pid)
+                    self.workers.pop(pid, None)
+            if pending and time.time() >= deadline:
+                for pid in pending:
+                    self.logger.warning("Worker {:d} did not stop in time, killing it".format(pid))
+                    self._kill(pid, signal.SIGKILL)
+                deadline = float('inf')
+            time.sleep(0.05)
+
+    def _kill(self, pid: int, signum: int):
+        try:
+            os.kill(pid, signum)
+        except OSError:
+            pass
+
+    def report_memory(self):
+        MB = 2 ** 20
+        pids = [os.getpid()] + sorted(self.workers)
+        lines = ['{:>8s} {:>8s} {:>10s} {:>10s} {:>10s} {:>10s}'.format('process', 'pid', 'rss MB', 'pss MB', 'shared MB', 'private MB')]
+        total_pss = 0
+        for i, pid in enumerate(pids):
+            usage = memory_usage(pid)
+            total_pss += usage.get('pss', 0)
+            lines.append('{:>8s} {:8d} {:10.1f} {:10.1f} {:10.1f} {:10.1f}'.format(
+                'master' if i == 0 else 'worker',
+                pid,
+                usage.get('rss', 0) / MB,
+                usage.get('pss', 0) / MB,
+                usage.get('shared', 0) / MB,
+                usage.get('private', 0) / MB,
+            ))
+        lines.append('total pss {:.1f} MB'.format(total_pss / MB))
+        self.logger.info('Memory usage\n' + '\n'.join(lines))
@@ -0,0 +1,229 @@
+import pdb
+import time
+
+from concurrent.futures import (
+    ProcessPoolExecutor,
+    as_completed,
+)
+
+from multiprocessing import cpu_count
+
+import numpy as np  # type: ignore
+
+from numpy.lib.format import open_memmap  # type: ignore
+
+from scipy.sparse import (  # type: ignore
+    csc_matrix,
+    csr_matrix,
+)
+
+from typing import (
+    Dict,
+    Optional,
+    Tuple,
+    Union,
+)
+
+from .data import (
+    SharedArrays,
+    load_shared_array,
+)
+
+
+MIN_SUPPORT = 5
+
+# A block of jokes holds, per pair of jokes, the six statistics, the
+# similarities and the temporaries of `pearson`, all of them as float64
+BYTES_PER_BLOCK_ENTRY = 12 * 8
+DEFAULT_MAX_MEMORY = 2 ** 28
+
+Columns = Tuple[csc_matrix, csc_matrix, csc_matrix]
+Neighbours = Tuple[np.array, np.array]
+
+
+def pearson(support, sums_i, sums_j, sums_sq_i, sums_sq_j, prods, min_support=MIN_SUPPORT):
+    # Pearson correlation of the ratings of two jokes, `i` and `j`, on the
+    # users that rated both from the sufficient statistics: `support` counts
+    # these users, `sums_i` and `sums_sq_i` add up the ratings of `i` (and
+    # their squares) over them, `prods` sums the products of the ratings.
+    eps = np.finfo(np.float64).eps
+    with np.errstate(divide='ignore', invalid='ignore'):
+        numer = prods - sums_i * sums_j / support
+        var_i = sums_sq_i - sums_i ** 2 / support
+        var_j = sums_sq_j - sums_j ** 2 / support
+        var_i[var_i <= eps * sums_sq_i] = 0
+        var_j[var_j <= eps * sums_sq_j] = 0
+        denom = np.sqrt(var_i * var_j)
+        sims = numer / denom
+    sims[np.logical_or(support < min_support, np.logical_not(denom > 0))] = 0
+    return np.clip(sims, -1, 1)
+
+
+def pearson_similarities(support, sums, sums_sq, prods, min_support=MIN_SUPPORT):
+    # The entry (i, j) of each statistic is computed on the users that rated
+    # both jokes and `sums[i, j]` adds up the ratings of joke `i`.
+    sims = pearson(support, sums, sums.T, sums_sq, sums_sq.T, prods, min_support)
+    np.fill_diagonal(sims, 1)
+    return sims
+
+
+def top_n(scores: np.array, n: int) -> np.array:
+    # Column indices of the `n` largest scores of each row, by decreasing
+    # score and, for ties, by increasing index (as a stable sort of the rows
+    # would give); only the top of each row is sorted
+    nr_rows, nr_cols = scores.shape
+    n = min(n, nr_cols)
+    if n <= 0:
+        return np.zeros((nr_rows, 0), dtype=np.int64)
+    kth = -np.partition(-scores, n - 1, axis=1)[:, n - 1: n]
+    is_above = scores > kth
+    is_tie = scores == kth
+    nr_ties = n - np.sum(is_above, axis=1, keepdims=True)
+    _, cols = np.nonzero(is_above | (is_tie & (np.cumsum(is_tie, axis=1) <= nr_ties)))
+    cols = cols.reshape(nr_rows, n)
+    rows = np.arange(nr_rows)[:, np.newaxis]
+    return cols[rows, np.argsort(-scores[rows, cols], axis=1, kind='mergesort')]
+
+
+def to_columns(user_joke_matrix: csr_matrix) -> Columns:
+    # The rated indicators, the ratings and their squares in the CSC format,
+    # from which the columns of a block of jokes are sliced; the three
+    # matrices share the sparsity structure of the ratings
+    ratings = user_joke_matrix.tocsc()
+    rated = csc_matrix((np.ones_like(ratings.data), ratings.indices, ratings.indptr), shape=ratings.shape)
+    ratings_sq = csc_matrix((ratings.data ** 2, ratings.indices, ratings.indptr), shape=ratings.shape)
+    return rated, ratings, ratings_sq
+
+
+def block_similarities(columns: Columns, block: slice, min_support: int=MIN_SUPPORT) -> np.array:
+    # The rows `block` of the similarities, from the products of the column
+    # tile of the block with all the columns
+    rated, ratings, ratings_sq = columns
+    sims = pearson(
+        rated[:, block].T.dot(rated).toarray(),
+        ratings[:, block].T.dot(rated).toarray(),
+        rated[:, block].T.dot(ratings).toarray(),
+        ratings_sq[:, block].T.dot(rated).toarray(),
+        rated[:, block].T.dot(ratings_sq).toarray(),
+        ratings[:, block].T.dot(ratings).toarray(),
+        min_support,
+    )
+    iids = np.arange(block.start, block.stop)
+    sims[np.arange(len(iids)), iids] = 1
+    return sims
+
+
+def process_block(columns: Columns, block: slice, nr_neighbours: Optional[int], output: Optional[np.array], min_support: int=MIN_SUPPORT) -> Optional[Neighbours]:
+    # Either writes the similarities of the block to `output` or returns the
+    # top `nr_neighbours` of each of its jokes, excluding the joke itself
+    sims = block_similarities(columns, block, min_support)
+    if nr_neighbours is None:
+        output[block] = sims
+        return None
+    iids = np.arange(block.start, block.stop)
+    rows = np.arange(len(iids))[:, np.newaxis]
+    sims[rows[:, 0], iids] = -np.inf
+    top = top_n(sims, nr_neighbours)
+    return top.astype(np.int32), sims[rows, top].astype(np.float32)
+
+
+# The arrays of the columns when shared with worker processes; the three
+# matrices have the same sparsity structure
+SHARED_NAMES = ('indices', 'indptr', 'rated', 'ratings', 'ratings_sq', 'shape')
+
+
+def share_columns(columns: Columns) -> SharedArrays:
+    rated, ratings, ratings_sq = columns
+    arrays = (ratings.indices, ratings.indptr, rated.data, ratings.data, ratings_sq.data, np.array(ratings.shape))
+    return SharedArrays(dict(zip(SHARED_NAMES, arrays)))
+
+
+# The columns loaded by a worker process, by the path of the shared files
+_loaded_columns = {}  # type: Dict[str, Columns]
+
+
+def load_shared_columns(path: str) -> Columns:
+    if path not in _loaded_columns:
+        load = lambda name: load_shared_array(path, name)
+        indices, indptr = load('indices'), load('indptr')
+        shape = tuple(load('shape'))
+        _loaded_columns[path] = tuple(
+            csc_matrix((load(name), indices, indptr), shape=shape)
+            for name in ('rated', 'ratings', 'ratings_sq')
+        )
+    return _loaded_columns[path]
+
+
+def process_shared_block(path: str, block: slice, nr_neighbours: Optional[int], output_path: Optional[str], min_support: int) -> Tuple[slice, Optional[Neighbours]]:
+    output = open_memmap(output_path, mode='r+') if output_path else None
+    result = process_block(load_shared_columns(path), block, nr_neighbours, output, min_support)
+    if output is not None:
+        output.flush()
+    return block, result
+
+
+def build_similarities(
+        user_joke_matrix: csr_matrix,
+        nr_neighbours: int=None,
+        path: str=None,
+        max_memory: int=DEFAULT_MAX_MEMORY,
+        nr_jobs: int=1,
+        verbose: int=0,
+        min_support: int=MIN_SUPPORT) -> Union[np.array, Neighbours]:
+    # The Pearson similarities of all the pairs of jokes, computed for blocks
+    # of jokes whose size is set by `max_memory` (bytes per block, hence per
+    # process) and spread over `nr_jobs` processes (all the cores if None).
+    # Without `nr_neighbours`, the result is the dense matrix of similarities,
+    # memory-mapped from the file `path` if given; otherwise, it is the top
+    # `nr_neighbours` of each joke and their similarities.
+    _, nr_jokes = user_joke_matrix.shape
+    nr_jobs = nr_jobs or cpu_count()
+    if nr_neighbours is not None:
+        nr_neighbours = min(nr_neighbours, nr_jokes - 1)
+    block_size = max(1, max_memory // (BYTES_PER_BLOCK_ENTRY * max(nr_jokes, 1)))
+    blocks = [slice(start, min(start + block_size, nr_jokes)) for start in range(0, nr_jokes, block_size)]
+
+    def collect(i: int, block: slice, result: Optional[Neighbours]):
+        if result is not None:
+            neighbours[block], neighbour_sims[block] = result
+        if verbose:
+            message = 'similarities: {:d}/{:d} blocks, {:.1f}s'
+            print(message.format(i, len(blocks), time.time() - start))
+
+    if nr_neighbours is not None:
+        neighbours = np.zeros((nr_jokes, nr_neighbours), dtype=np.int32)
+        neighbour_sims = np.zeros((nr_jokes, nr_neighbours), dtype=np.float32)
+
+    start = time.time()
+    columns = to_columns(user_joke_matrix)
+    if nr_jobs == 1 or len(blocks) == 1:
+        output = None  # type: np.array
+        if nr_neighbours is None:
+            shape = (nr_jokes, nr_jokes)
+            output = open_memmap(path, mode='w+', dtype=np.float64, shape=shape) if path else np.zeros(shape)
+        for i, block in enumerate(blocks, start=1):
+            collect(i, block, process_block(columns, block, nr_neighbours, output, min_support))
+        return output if nr_neighbours is None else (neighbours, neighbour_sims)
+
+    # The workers write the dense similarities to a file, which is a
+    # temporary one in shared memory if no `path` is given
+    shared_columns = share_columns(columns)
+    del columns
+    try:
+        output_path = None  # type: str
+        if nr_neighbours is None:
+            output_path = path or shared_columns.get_path('sims')
+            open_memmap(output_path, mode='w+', dtype=np.float64, shape=(nr_jokes, nr_jokes)).flush()
+        with ProcessPoolExecutor(max_workers=nr_jobs) as executor:
+            futures = [
+                executor.submit(process_shared_block, shared_columns.path, block, nr_neighbours, output_path, min_support)
+                for block in blocks
+            ]
+            for i, future in enumerate(as_completed(futures), start=1):
+                collect(i, *future.result())
+        if nr_neighbours is None:
+            output = open_memmap(output_path, mode='r+')
+            return output if path else np.array(output)
+        return neighbours, neighbour_sims
+    finally:
+        shared_columns.close()
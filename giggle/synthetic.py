@@ -0,0 +1,116 @@
+import os
+import pdb
+
+from itertools import count
+
+import numpy as np  # type: ignore
+
+from pandas import (  # type: ignore
+    DataFrame,
+    concat,
+)
+
+from typing import (
+    Iterable,
+    Sequence,
+)
+
+from .data import (
+    CHUNK_SIZE,
+    SEED,
+    Data,
+)
+
+
+# Shape of the Jester ratings: 59,132 users rated on average 30 out of the
+# 150 jokes; every user rated the jokes of the gauge set
+JESTER_NR_USERS = 59132
+JESTER_NR_JOKES = 150
+JESTER_NR_RATINGS_PER_USER = 30
+GAUGE_JOKES = (5, 7, 8, 13, 15, 16, 17, 18, 19, 20)
+
+NR_FACTORS = 5
+MAX_CHUNK_ENTRIES = 2 ** 22
+
+
+def generate_ratings(
+        nr_users: int=JESTER_NR_USERS,
+        nr_jokes: int=JESTER_NR_JOKES,
+        nr_ratings_per_user: float=JESTER_NR_RATINGS_PER_USER,
+        gauge_jokes: Sequence[int]=GAUGE_JOKES,
+        skew: float=1.0,
+        seed: int=SEED) -> Iterable[DataFrame]:
+    # Yields the ratings in chunks of users, sorted by user and joke. Each
+    # user rates the gauge jokes and a geometric number of other jokes,
+    # picked according to a Zipf-like popularity of exponent `skew`. The
+    # ratings come from a low-rank model with biases and noise, clipped to
+    # the range of the Jester ratings.
+    random_state = np.random.RandomState(seed)
+    gauge_iids = np.array([joke_id - 1 for joke_id in gauge_jokes if joke_id <= nr_jokes], dtype=np.int64)
+    nr_extra = max(nr_ratings_per_user - len(gauge_iids), 0)
+
+    popularity = 1 / np.arange(1, nr_jokes + 1) ** skew
+    log_popularity = np.log(random_state.permutation(popularity))
+    log_popularity[gauge_iids] = np.inf
+
+    q_joke = random_state.randn(nr_jokes, NR_FACTORS)
+    b_joke = 1.5 * random_state.randn(nr_jokes)
+
+    chunk_size = max(1, min(CHUNK_SIZE // max(int(nr_ratings_per_user), 1), MAX_CHUNK_ENTRIES // nr_jokes))
+    for start in range(0, nr_users, chunk_size):
+        size = min(chunk_size, nr_users - start)
+        nr_rated = len(gauge_iids) + np.minimum(
+            random_state.geometric(1 / (nr_extra + 1), size) - 1,
+            nr_jokes - len(gauge_iids),
+        )
+        # Gumbel top-k trick: sampling without replacement for all users
+        keys = log_popularity - np.log(-np.log(random_state.rand(size, nr_jokes)))
+        ranks = np.argsort(np.argsort(-keys, axis=1), axis=1)
+        user_iids, joke_iids = np.nonzero(ranks < nr_rated[:, np.newaxis])
+
+        p_user = random_state.randn(size, NR_FACTORS)
+        b_user = 2.5 * random_state.randn(size)
+        ratings = (
+            1.0 +
+            b_user[user_iids] +
+            b_joke[joke_iids] +
+            np.sum(p_user[user_iids] * q_joke[joke_iids], axis=1) +
+            3.0 * random_state.randn(len(user_iids))
+        )
+        yield DataFrame({
+            'user_id': start + user_iids + 1,
+            'joke_id': joke_iids + 1,
+            'rating': np.clip(ratings, -10, 10).round(3),
+        }, columns=['user_id', 'joke_id', 'rating'])
+
+
+def generate_data(**kwargs) -> Data:
+    # In-memory version, with the same layout as `Dataset.get_data`
+    data_frame = concat(generate_ratings(**kwargs), ignore_index=True)
+    users = np.unique(data_frame.user_id.values)
+    jokes = np.unique(data_frame.joke_id.values)
+    user_to_iid = dict(zip(users.tolist(), count()))
+    joke_to_iid = dict(zip(jokes.tolist(), count()))
+    return Data(data_frame, users, jokes, user_to_iid, joke_to_iid)
+
+
+def write_ratings_file(path: str, chunks: Iterable[DataFrame]) -> int:
+    # Same format as `jester_ratings.dat`, one triplet per line
+    nr_rows = 0
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as f:
+        for chunk in chunks:
+            chunk.to_csv(f, sep=' ', header=False, index=False, float_format='%.3f')
+            nr_rows += len(chunk)
+    return nr_rows
+
+
+def populate_database(engine, path: str):
+    # Creates the tables of the `User`, `Joke` and `Rating` models, for
+    # example in a local SQLite file, and loads the ratings file into them
+    from .models import (
+        bulk_load,
+        db,
+    )
+    db.metadata.create_all(engine)
+    bulk_load(engine, path)
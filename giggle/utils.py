@@ -1,15 +1,20 @@
 import functools
 import itertools
 import json
+import threading
 import traceback
 
+from contextlib import contextmanager
 
-def wrap_exceptions(func, logger=None):
+
+def wrap_exceptions(func, logger=None, counter=None):
     @functools.wraps(func)
     def func_wrapper(*args, **kwargs):
         try:
             return func(*args, **kwargs)
         except Exception as e:
+            if counter:
+                counter.inc(function=func.__name__, exception=type(e).__name__)
             return _error_as_json(e, logger)
     return func_wrapper
 
@@ -25,3 +30,51 @@ def _error_as_json(ex, logger=None, status=500):
 def grouper(iterable, n, fillvalue=None):
     args = [iter(iterable)] * n
     return itertools.zip_longest(*args, fillvalue=fillvalue)
+
+
+class ReadWriteLock:
+    "Lock held either by any number of readers or by a single writer"
+
+    def __init__(self) -> None:
+        self._condition = threading.Condition()
+        self._nr_readers = 0
+        self._nr_writers = 0
+        self._is_writing = False
+
+    @contextmanager
+    def reading(self):
+        # The waiting writers go first, so that they are not starved; hence
+        # a thread must not read again while it reads
+        with self._condition:
+            while self._nr_writers:
+                self._condition.wait()
+            self._nr_readers += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._nr_readers -= 1
+                if not self._nr_readers:
+                    self._condition.notify_all()
+
+    @contextmanager
+    def writing(self):
+        with self._condition:
+            self._nr_writers += 1
+            while self._nr_readers or self._is_writing:
+                self._condition.wait()
+            self._is_writing = True
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._is_writing = False
+                self._nr_writers -= 1
+                self._condition.notify_all()
+
+    def __getstate__(self):
+        # Copies sent to other processes get a lock of their own
+        return {}
+
+    def __setstate__(self, state):
+        self.__init__()
@@ -1,18 +1,28 @@
+import atexit
+import hmac
 import logging
 import pdb
 import os
+import socket
+import time
 
-from itertools import repeat
+from threading import (
+    Lock,
+    Thread,
+)
 
 from flask import (  # type: ignore
     Flask,
     abort,
+    g,
     jsonify,
     request,
 )
 
 from flask_sqlalchemy import SQLAlchemy  # type: ignore
 
+from sqlalchemy import func  # type: ignore
+
 from functools import partial
 
 from logging import config as cfg
@@ -27,15 +37,42 @@ from typing import (
     Tuple,
 )
 
+from .batching import (
+    MicroBatcher,
+    WriteBehind,
+)
+
 from .config import Config
 
-from .recommender import (
-    get_recommender_path,
-    load_recommender,
+from .index import RatingIndex
+
+from .metrics import (
+    CONTENT_TYPE,
+    Counter,
+    Gauge,
+    Histogram,
+    render,
+)
+
+from .serving import memory_usage
+
+from .recommender import Recommender
+
+from .registry import (
+    VersionWatcher,
+    get_current_version,
+    list_versions,
+    load_version,
+    set_current_version,
 )
 
 from .models import (
     Rating,
+    RatingLog,
+    RatingLogReader,
+    log_ratings,
+    trim_rating_log,
+    upsert_ratings,
 )
 
 from .utils import (
@@ -49,33 +86,345 @@ db = SQLAlchemy(app)
 # Set-up logging
 cfg.fileConfig('./config/web-service.conf')
 logger = logging.getLogger('web-service')
-wrap_exceptions_logger = partial(wrap_exceptions, logger=logger)
+
+# Metrics, exposed at `/metrics`
+REQUESTS = Counter('giggle_requests_total', 'Requests by route, method and status.', ('route', 'method', 'status'))
+REQUEST_LATENCY = Histogram('giggle_request_duration_seconds', 'Latency of the requests by route.', ('route', ))
+REQUESTS_IN_FLIGHT = Gauge('giggle_requests_in_flight', 'Requests being handled by route.', ('route', ))
+PHASE_LATENCY = Histogram('giggle_phase_duration_seconds', 'Time spent in each phase of the requests.', ('phase', ))
+ERRORS = Counter('giggle_errors_total', 'Exceptions caught in the handlers.', ('function', 'exception'))
+PROCESS_MEMORY = Gauge('giggle_process_memory_bytes', 'Memory of the process serving the request, by kind.', ('kind', ))
+MODEL_RELOADS = Counter('giggle_model_reloads_total', 'Reloads of the model by outcome.', ('status', ))
+MODEL_LOAD_LATENCY = Histogram('giggle_model_load_duration_seconds', 'Time to load and warm up a version of the model.')
+
+wrap_exceptions_logger = partial(wrap_exceptions, logger=logger, counter=ERRORS)
 
 
 recommender_key = os.getenv('RECOMMENDER')
-recommender = load_recommender(get_recommender_path(recommender_key))
 
 
-def get_unrated_jokes(user_id: int) -> List[int]:
-    jokes = set(joke_id for joke_id, in Rating.query.with_entities(Rating.joke_id).distinct(Rating.joke_id))
-    jokes_rated = set(joke_id for joke_id, in Rating.query.with_entities(Rating.joke_id).filter_by(user_id=user_id))
-    return list(jokes - jokes_rated)
+class Model:
+    "A loaded version of the recommender"
+
+    def __init__(self, recommender: Recommender, version: str) -> None:
+        self.recommender = recommender
+        self.version = version
+        self.loaded_at = time.time()
+
+
+def load_model(version: str=None) -> Model:
+    with MODEL_LOAD_LATENCY.time():
+        version, recommender = load_version(recommender_key, version)
+        # A first recommendation checks the model and maps its pages
+        recommender.recommend([-1], 1, rated=[[]])
+    return Model(recommender, version)
+
+
+# The served model is replaced as a whole on reload: the handlers take a
+# reference to it once, so a request is answered by a single version
+model = load_model()
+recommender_lock = Lock()
+reload_lock = Lock()
+
+
+def reload_model(version: str=None) -> Model:
+    # Loads a version (by default, the current one) while the old one keeps
+    # serving, then swaps them; the ratings added to the old model since it
+    # was trained are in the database, but not in the new model
+    global model
+    with reload_lock:
+        try:
+            new_model = load_model(version)
+        except Exception:
+            MODEL_RELOADS.inc(status='error')
+            raise
+        model = new_model
+    MODEL_RELOADS.inc(status='ok')
+    logger.info("Serving version {} of the model {}".format(new_model.version, recommender_key))
+    return new_model
+
+
+def reload_current_version(version: str):
+    # The version may already be served, e.g. after `/admin/reload`
+    if version == model.version:
+        return
+    try:
+        reload_model(version)
+    except Exception:
+        logger.exception("Failed to load version {} of the model {}".format(version, recommender_key))
+
+
+# The `CURRENT` file of the registry is checked every `MODEL_POLL_SECONDS`
+# seconds by each process, and a new current version is loaded and swapped
+MODEL_POLL_SECONDS = float(os.getenv('MODEL_POLL_SECONDS', 10))
+watcher = VersionWatcher(recommender_key, reload_current_version, MODEL_POLL_SECONDS) if MODEL_POLL_SECONDS > 0 else None
+
+# Admin end-points are enabled by setting `ADMIN_TOKEN`, which requests pass
+# in the `X-Admin-Token` header
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
+
+
+def load_rating_index() -> RatingIndex:
+    # Streams the rated pairs from the database in a single query
+    query = Rating.query.with_entities(Rating.user_id, Rating.joke_id)
+    return RatingIndex.from_pairs(query.yield_per(10000))
+
+
+class RatingFollower:
+    "Applies the ratings logged in the database by all the processes"
+
+    def __init__(self, interval: float, batch_size: int=10000, trim_interval: float=10) -> None:
+        # Each process, its own ratings included, applies the logged ratings
+        # in their order and only through the log, so all of them end up with
+        # the latest ratings, each applied once. The ratings logged before the
+        # process started are in the rating index, but only those the model
+        # was trained on are in the model. With `interval` 0 nothing is polled:
+        # the ratings are applied when written, and by the master before it
+        # forks a worker.
+        self.interval = interval
+        self.batch_size = batch_size
+        self.trim_interval = trim_interval
+        # A process that did not report for that long is considered stopped
+        self.max_age = max(60, 10 * interval)
+        with app.app_context():
+            RatingLog.__table__.create(db.engine, checkfirst=True)
+            RatingLogReader.__table__.create(db.engine, checkfirst=True)
+            self.last_id = db.session.query(func.max(RatingLog.id)).scalar() or 0
+        self._lock = Lock()
+        self._pid = None  # type: int
+        self._trimmed_at = 0.0
+
+    def ensure_started(self):
+        # As for the version watcher, forked processes start their own thread
+        if self.interval <= 0 or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            Thread(target=self._run, daemon=True).start()
+            self._pid = os.getpid()
+
+    def catch_up(self) -> int:
+        nr_rows = 0
+        with self._lock, app.app_context():
+            while True:
+                query = db.session.query(RatingLog.id, RatingLog.user_id, RatingLog.joke_id, RatingLog.rating)
+                rows = query.filter(RatingLog.id > self.last_id).order_by(RatingLog.id).limit(self.batch_size).all()
+                if not rows:
+                    break
+                apply_ratings([(user_id, joke_id, rating) for _, user_id, joke_id, rating in rows])
+                self.last_id = rows[-1][0]
+                nr_rows += len(rows)
+        if time.time() - self._trimmed_at >= self.trim_interval:
+            self.trim()
+        return nr_rows
+
+    def trim(self) -> int:
+        # Reports how far this process got and deletes the rows applied by
+        # all the running processes
+        with self._lock, app.app_context(), db.engine.begin() as connection:
+            reader = '{:s}-{:d}'.format(socket.gethostname(), os.getpid())[-80:]
+            nr_rows = trim_rating_log(connection, reader, self.last_id, self.max_age)
+        self._trimmed_at = time.time()
+        return nr_rows
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.catch_up()
+            except Exception:
+                logger.exception("Failed to apply the logged ratings")
+
+
+# With several workers, every `RATINGS_POLL_SECONDS` seconds each of them
+# applies the ratings written by the others; see `follow_ratings`
+RATINGS_POLL_SECONDS = float(os.getenv('RATINGS_POLL_SECONDS', 1))
+follower = None  # type: RatingFollower
+
+
+def follow_ratings(nr_workers: int):
+    # Called before forking the workers: the ratings are then logged, and
+    # applied from the log by every process
+    global follower
+    if RATINGS_POLL_SECONDS > 0:
+        follower = RatingFollower(RATINGS_POLL_SECONDS if nr_workers > 1 else 0)
+
+with app.app_context():
+    rating_index = load_rating_index()
+
+
+def recommend(user_ids_n: np.array) -> List[List[int]]:
+    # Each row holds a user and the number of jokes to recommend; the rated
+    # jokes are taken from the index, which is the most up to date
+    user_ids = user_ids_n[:, 0].tolist()
+    with PHASE_LATENCY.time(phase='index'):
+        rated = [rating_index.get_rated_jokes(user_id) for user_id in user_ids]
+    recommender = model.recommender
+    with PHASE_LATENCY.time(phase='recommend'):
+        top_jokes = recommender.recommend(user_ids, max(user_ids_n[:, 1].tolist() or [0]), rated=rated)
+    return [jokes[:n] for jokes, n in zip(top_jokes, user_ids_n[:, 1])]
+
+
+# Optional micro-batching: the recommendations of concurrent requests are
+# gathered for up to `BATCH_WINDOW_MS` milliseconds (or `BATCH_MAX_SIZE`
+# requests) and computed with a single call to the recommender
+BATCH_WINDOW_MS = float(os.getenv('BATCH_WINDOW_MS', 0))
+BATCH_MAX_SIZE = int(os.getenv('BATCH_MAX_SIZE', 32))
+batcher = MicroBatcher(recommend, BATCH_WINDOW_MS / 1000, BATCH_MAX_SIZE) if BATCH_WINDOW_MS > 0 else None
+
+
+def apply_ratings(rows: List[Tuple[int, int, float]]):
+    # Updates are serialized, predictions are served meanwhile
+    recommender = model.recommender
+    with PHASE_LATENCY.time(phase='update'):
+        for user_id, joke_id, rating in rows:
+            rating_index.add(user_id, joke_id)
+            with recommender_lock:
+                recommender.update(user_id, joke_id, rating)
+
+
+def ratings_written(rows: List[Tuple[int, int, float]]):
+    # Logged ratings are applied from the log, which holds them in order
+    if follower:
+        follower.catch_up()
+    else:
+        apply_ratings(rows)
+
+
+def write_ratings(rows: List[Tuple[int, int, float]]):
+    # Writes a batch of queued ratings in a single transaction; the
+    # predictions see them only once they are in the database, through
+    # `ratings_written`
+    with PHASE_LATENCY.time(phase='db'), app.app_context(), db.engine.begin() as connection:
+        upsert_ratings(connection, rows)
+        if follower:
+            log_ratings(connection, rows)
+
+
+# Optional write-behind: the new ratings are queued and written in batches of
+# up to `WRITE_BEHIND_MAX_ROWS` rows, at most `WRITE_BEHIND_MS` milliseconds
+# after they arrived; a rating for an already rated joke replaces the old
+# one. Requests get a 503 while `WRITE_BEHIND_QUEUE_SIZE` rows are waiting.
+WRITE_BEHIND_MS = float(os.getenv('WRITE_BEHIND_MS', 0))
+WRITE_BEHIND_MAX_ROWS = int(os.getenv('WRITE_BEHIND_MAX_ROWS', 500))
+WRITE_BEHIND_QUEUE_SIZE = int(os.getenv('WRITE_BEHIND_QUEUE_SIZE', 10000))
+writer = WriteBehind(
+    write_ratings,
+    WRITE_BEHIND_MAX_ROWS,
+    WRITE_BEHIND_MS / 1000,
+    WRITE_BEHIND_QUEUE_SIZE,
+    logger,
+    on_written=ratings_written,
+) if WRITE_BEHIND_MS > 0 else None
+
+
+def before_fork():
+    # Forked workers open their own database connections, and share the
+    # current version of the model and the ratings logged so far: this
+    # process catches up first, so that restarted workers start up to date
+    version = get_current_version(recommender_key)
+    if version is not None:
+        reload_current_version(version)
+    if follower:
+        follower.catch_up()
+        follower.trim()
+    with app.app_context():
+        db.engine.dispose()
+
+
+def shutdown():
+    # The queued ratings are written on a normal shutdown
+    if writer:
+        writer.close()
+
+
+atexit.register(shutdown)
+
+
+def get_route() -> str:
+    # The rule, not the path, to keep the number of label values small
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+
+@app.before_request
+def start_request():
+    if watcher:
+        watcher.ensure_started()
+    if follower:
+        follower.ensure_started()
+    g.start = time.time()
+    g.route = get_route()
+    REQUESTS_IN_FLIGHT.inc(route=g.route)
+
+
+@app.after_request
+def end_request(response):
+    REQUESTS.inc(route=g.route, method=request.method, status=response.status_code)
+    REQUEST_LATENCY.observe(time.time() - g.start, route=g.route)
+    return response
+
+
+@app.teardown_request
+def teardown_request(exception):
+    if 'route' in g:
+        REQUESTS_IN_FLIGHT.dec(route=g.route)
+
+
+# Largest number of users in a request to `/predictInterestsBatch/`
+MAX_BATCH_USERS = int(os.getenv('MAX_BATCH_USERS', 1000))
+
+
+def is_int64(value) -> bool:
+    # JSON booleans are integers in Python, but not identifiers
+    return isinstance(value, int) and not isinstance(value, bool) and -2 ** 63 <= value < 2 ** 63
+
+
+def predict_top_jokes(user_ids: List[int], n: int) -> List[List[int]]:
+    # The best `n` unrated jokes for each of the users
+    user_ids_n = np.column_stack((user_ids, np.full(len(user_ids), n))).astype(np.int64).reshape(-1, 2)
+    return (batcher or recommend)(user_ids_n)
 
 
 @app.route('/predictInterests/<user_id>')
 @wrap_exceptions_logger
 def predict_interests(user_id):
     user_id = int(user_id)
-    jokes = get_unrated_jokes(user_id)
-    user_joke_ids = list(zip(repeat(user_id), jokes))
-    predictions = zip(recommender.predict_multi(user_joke_ids), jokes)
-    predictions = sorted(predictions, reverse=True)
-    predictions = [j for _, j in predictions[:5]]
-    json_data = dumps(predictions, indent=4)
+    predictions, = predict_top_jokes([user_id], n=5)
+    with PHASE_LATENCY.time(phase='serialize'):
+        json_data = dumps(predictions, indent=4)
     logger.info(json_data)
     return json_data, 200
 
 
+@app.route('/predictInterestsBatch/', methods=['POST'])
+@wrap_exceptions_logger
+def predict_interests_batch():
+    json_data = request.get_json()
+
+    if not json_data or 'users' not in json_data:
+        return jsonify("Bad request"), 400
+
+    user_ids = json_data['users']
+    n = json_data.get('n', 5)
+
+    if not isinstance(user_ids, list) or not all(is_int64(user_id) for user_id in user_ids):
+        return jsonify("Bad request: users must be a list of integers"), 400
+    if len(user_ids) > MAX_BATCH_USERS:
+        return jsonify("Bad request: at most {:d} users per request".format(MAX_BATCH_USERS)), 400
+    if not is_int64(n) or n < 1:
+        return jsonify("Bad request: n must be a positive integer"), 400
+
+    predictions = predict_top_jokes(user_ids, n)
+
+    with PHASE_LATENCY.time(phase='serialize'):
+        json_data = jsonify({
+            str(user_id): jokes
+            for user_id, jokes in zip(user_ids, predictions)
+        })
+    return json_data, 200
+
+
 @app.route('/addData/', methods=['POST'])
 @wrap_exceptions_logger
 def add_data():
@@ -90,8 +439,22 @@ def add_data():
         rating=json_data.get('rating'),
     )
 
-    db.session.add(rating)
-    db.session.commit()
+    if writer:
+        # Checked here, since a failing row is only noticed once written
+        try:
+            row = (int(rating.user_id), int(rating.joke_id), float(rating.rating))
+        except (TypeError, ValueError):
+            return jsonify("Bad request"), 400
+        if not writer.put(row):
+            return jsonify("Too many pending ratings, retry later"), 503, {'Retry-After': '1'}
+        return jsonify(json_data), 202
+
+    with PHASE_LATENCY.time(phase='db'):
+        db.session.add(rating)
+        if follower:
+            db.session.add(RatingLog(user_id=rating.user_id, joke_id=rating.joke_id, rating=rating.rating))
+        db.session.commit()
+    ratings_written([(rating.user_id, rating.joke_id, rating.rating)])
 
     return jsonify(json_data), 201
 
@@ -99,25 +462,75 @@ def add_data():
 @app.route('/similarItems/<joke_id>')
 @wrap_exceptions_logger
 def similar_items(joke_id):
+    recommender = model.recommender
 
-    if not recommender_key.startswith('neigh'):
-        return jsonify("End-point works only with neighbourhood-based method"), 400
-
-    joke_to_iid = recommender.data.joke_to_iid
-    iid_to_joke = {i: j for j, i in joke_to_iid.items()}
+    if not hasattr(recommender, 'similar_jokes'):
+        return jsonify("End-point works only with methods that have joke similarities"), 400
 
     joke_id = int(joke_id)
-    joke_iid = joke_to_iid[joke_id]
-
-    iids = np.argsort(-recommender.sims[joke_iid])
-
-    json_data = [
-        {
-            'id': int(iid_to_joke[iid]),
-            'similarity': float(recommender.sims[joke_iid, iid]),
-        }
-        for iid in iids
-        if iid != joke_iid
-    ]
-    json_data = json_data[:5]
-    return jsonify(json_data), 200
+    joke_iid = recommender.joke_to_iid[joke_id]
+    # Only the most similar jokes are stored, `NR_SIMILAR_JOKES` at most
+    max_n = recommender.similar_jokes.shape[1]
+    n = request.args.get('n', min(5, max_n), type=int)
+
+    if not 1 <= n <= max_n:
+        return jsonify("Bad request: n must be between 1 and {:d}".format(max_n)), 400
+
+    with PHASE_LATENCY.time(phase='serialize'):
+        json_data = jsonify([
+            {
+                'id': int(similar_joke_id),
+                'similarity': float(similarity),
+            }
+            for similar_joke_id, similarity in zip(
+                recommender.similar_jokes[joke_iid, :n],
+                recommender.similar_sims[joke_iid, :n],
+            )
+        ])
+    return json_data, 200
+
+
+def get_status() -> Dict[str, object]:
+    current_model = model
+    return {
+        'recommender': recommender_key,
+        'version': current_model.version,
+        'current_version': get_current_version(recommender_key),
+        'loaded_at': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(current_model.loaded_at)),
+        'pid': os.getpid(),
+    }
+
+
+@app.route('/status')
+@wrap_exceptions_logger
+def status():
+    return jsonify(get_status()), 200
+
+
+@app.route('/admin/reload', methods=['POST'])
+@wrap_exceptions_logger
+def admin_reload():
+    token = request.headers.get('X-Admin-Token', '')
+    if not ADMIN_TOKEN or not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        return jsonify("Forbidden"), 403
+    json_data = request.get_json(silent=True) or {}
+    version = json_data.get('version') or get_current_version(recommender_key)
+    if version is not None and version not in list_versions(recommender_key):
+        return jsonify("Unknown version {} of the model {}".format(version, recommender_key)), 404
+    try:
+        reload_model(version)
+    except Exception:
+        logger.exception("Failed to load version {} of the model {}".format(version, recommender_key))
+        return jsonify("Failed to load version {}".format(version)), 500
+    # Made the current version once loaded, so that all the processes load it
+    if version is not None:
+        set_current_version(recommender_key, version)
+    return jsonify(get_status()), 200
+
+
+@app.route('/metrics')
+def metrics():
+    # With several workers, each one reports its own metrics
+    for kind, value in memory_usage(os.getpid()).items():
+        PROCESS_MEMORY.set(value, kind=kind)
+    return render(), 200, {'Content-Type': CONTENT_TYPE}
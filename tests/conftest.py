@@ -0,0 +1,26 @@
+import os
+
+from sqlalchemy import create_engine  # type: ignore
+
+from giggle.data import RATINGS_PATH
+
+from giggle.synthetic import (
+    generate_ratings,
+    populate_database,
+    write_ratings_file,
+)
+
+
+SYNTHETIC_PATH = 'data/synthetic/tests'
+
+
+def pytest_configure(config):
+    # Without a database or the Jester ratings, the tests run on synthetic
+    # ratings loaded into a local SQLite file
+    if os.getenv('DATABASE_URL') or os.path.exists(RATINGS_PATH):
+        return
+    db_path = os.path.abspath(SYNTHETIC_PATH + '.db')
+    if not os.path.exists(db_path):
+        write_ratings_file(SYNTHETIC_PATH + '.dat', generate_ratings(nr_users=2000, nr_jokes=100))
+        populate_database(create_engine('sqlite:///' + db_path), SYNTHETIC_PATH + '.dat')
+    os.environ['DATABASE_URL'] = 'sqlite:///' + db_path
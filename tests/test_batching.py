@@ -0,0 +1,90 @@
+import threading
+
+import numpy as np
+
+import pytest
+
+from giggle.batching import (
+    MicroBatcher,
+    WriteBehind,
+)
+
+
+def test_micro_batcher():
+    calls = []
+
+    def func(rows):
+        calls.append(len(rows))
+        return rows.sum(axis=1)
+
+    batcher = MicroBatcher(func, window=0.05, max_batch_size=8)
+    inputs = [np.arange(2 * i).reshape(-1, 2) for i in range(8)]
+    outputs = [None] * len(inputs)
+
+    def call(i):
+        outputs[i] = batcher(inputs[i])
+
+    threads = [threading.Thread(target=call, args=(i, )) for i in range(len(inputs))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for rows, output in zip(inputs, outputs):
+        assert np.array_equal(output, rows.sum(axis=1))
+    # Concurrent calls are scored together
+    assert len(calls) < len(inputs)
+
+
+def test_micro_batcher_error():
+    def func(rows):
+        raise ValueError("bad rows")
+
+    batcher = MicroBatcher(func, window=0.001)
+    with pytest.raises(ValueError):
+        batcher(np.zeros((1, 2)))
+
+
+def test_write_behind():
+    batches = []
+    writer = WriteBehind(batches.append, max_rows=4, max_delay=0.05)
+    for i in range(10):
+        assert writer.put(i)
+    writer.close()
+    # All the rows are written, in order, by batches of at most `max_rows`
+    assert [row for batch in batches for row in batch] == list(range(10))
+    assert max(len(batch) for batch in batches) <= 4
+
+
+def test_write_behind_full():
+    written = []
+    release = threading.Event()
+
+    def func(rows):
+        release.wait()
+        written.extend(rows)
+
+    writer = WriteBehind(func, max_rows=1, max_delay=0, max_queue_size=2)
+    accepted = [i for i in range(10) if writer.put(i)]
+    # The writer is stuck on the first row, so the queue fills up
+    assert len(accepted) < 10
+    release.set()
+    writer.close()
+    assert written == accepted
+
+
+def test_write_behind_errors():
+    written = []
+
+    def func(rows):
+        if -1 in rows:
+            raise ValueError("Invalid row")
+        written.extend(rows)
+
+    notified = []
+    writer = WriteBehind(func, max_rows=4, max_delay=0.05, on_written=notified.append)
+    for i in [0, 1, -1, 2, 3]:
+        assert writer.put(i)
+    writer.close()
+    # Only the invalid row is dropped, and each written row is passed on once
+    assert written == [0, 1, 2, 3]
+    assert [row for batch in notified for row in batch] == [0, 1, 2, 3]
@@ -0,0 +1,76 @@
+import mmap
+import os
+
+import numpy as np
+
+from pandas import DataFrame
+
+from sqlalchemy import (  # type: ignore
+    create_engine,
+    text,
+)
+
+from giggle.data import (
+    load_ratings,
+    read_cache,
+    write_cache,
+)
+
+from giggle.models import (
+    db,
+    insert_ratings,
+)
+
+from giggle.synthetic import generate_ratings
+
+
+def is_memory_mapped(array: np.array) -> bool:
+    while array is not None:
+        if isinstance(array, mmap.mmap):
+            return True
+        array = getattr(array, 'base', None)
+    return False
+
+
+def get_chunks():
+    random_state = np.random.RandomState(0)
+    for start in range(0, 100, 30):
+        nr_rows = min(30, 100 - start)
+        yield DataFrame({
+            'user_id': random_state.randint(1, 50, nr_rows),
+            'joke_id': random_state.randint(1, 10, nr_rows),
+            'rating': random_state.uniform(-10, 10, nr_rows),
+        }, columns=['user_id', 'joke_id', 'rating'])
+
+
+def test_cache(tmpdir):
+    path = os.path.join(str(tmpdir), 'ratings')
+    write_cache(path, get_chunks(), 100, [100])
+    data_frame, users, jokes = read_cache(path)
+    # The columns are not copied from the snapshot (checked first, since
+    # `data_frame.values` consolidates the columns of the same type)
+    for column in data_frame.columns:
+        assert is_memory_mapped(data_frame[column].values)
+    expected = DataFrame(np.vstack([chunk.values for chunk in get_chunks()]), columns=data_frame.columns)
+    assert np.allclose(data_frame.values, expected.values)
+    assert np.array_equal(users, np.unique(expected.user_id))
+    assert np.array_equal(jokes, np.unique(expected.joke_id))
+
+
+def test_cache_refresh(tmpdir, monkeypatch):
+    # The snapshot of a database is rebuilt when a rating is changed
+    monkeypatch.chdir(str(tmpdir))
+    monkeypatch.setenv('DATABASE_URL', 'sqlite:///ratings.db')
+    engine = create_engine('sqlite:///ratings.db')
+    db.metadata.create_all(engine)
+    with engine.begin() as connection:
+        insert_ratings(connection, generate_ratings(nr_users=20, nr_jokes=10))
+    data_frame, _, _ = load_ratings()
+    user_id, joke_id, rating = data_frame.values[0]
+    with engine.begin() as connection:
+        connection.execute(
+            text('UPDATE ratings SET rating = :rating WHERE user_id = :user_id AND joke_id = :joke_id'),
+            {'rating': -rating if rating else 1.0, 'user_id': int(user_id), 'joke_id': int(joke_id)},
+        )
+    data_frame, _, _ = load_ratings()
+    assert np.isclose(data_frame.rating.values[0], -rating if rating else 1.0)
@@ -0,0 +1,41 @@
+import numpy as np
+
+from giggle.data import (
+    DATASETS,
+    SharedDataset,
+    share_dataset,
+)
+
+from giggle.evaluate import evaluate_folds
+
+from giggle.recommender import RECOMMENDERS
+
+
+dataset = DATASETS['small']()
+
+
+def test_shared_dataset():
+    shared_arrays = share_dataset(dataset)
+    try:
+        shared_dataset = SharedDataset(shared_arrays.path)
+        for i in range(dataset.nr_folds):
+            for idxs, shared_idxs in zip(dataset.load_fold(i), shared_dataset.load_fold(i)):
+                assert np.array_equal(idxs, shared_idxs)
+        idxs = dataset.folds[0]['te']
+        data = dataset.get_fold_data(idxs).data_frame
+        shared_data = shared_dataset.get_fold_data(idxs).data_frame
+        assert np.array_equal(data.values, shared_data.values)
+        assert shared_dataset.user_to_iid == dataset.user_to_iid
+    finally:
+        shared_arrays.close()
+
+
+def test_evaluate_jobs():
+    # The folds evaluated in parallel give the same results as in series
+    recommender = RECOMMENDERS['baseline']
+    results, data = evaluate_folds(dataset, recommender, nr_jobs=1)
+    results_jobs, data_jobs = evaluate_folds(dataset, recommender, nr_jobs=2)
+    assert np.allclose(results, results_jobs)
+    for (true, pred), (true_jobs, pred_jobs) in zip(data, data_jobs):
+        assert np.array_equal(true, true_jobs)
+        assert np.allclose(pred, pred_jobs)
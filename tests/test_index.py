@@ -0,0 +1,17 @@
+from giggle.index import (
+    RatingIndex,
+)
+
+
+def test_rating_index():
+    pairs = [(1, 10), (2, 30), (1, 20), (3, 10)]
+    index = RatingIndex.from_pairs(iter(pairs), chunk_size=3)
+    assert index.get_rated_jokes(1) == [10, 20]
+    assert index.get_rated_jokes(4) == []
+    index.add(1, 30)
+    index.add(1, 30)
+    index.add(4, 40)
+    assert index.get_rated_jokes(1) == [10, 20, 30]
+    assert index.get_rated_jokes(4) == [40]
+    assert index.jokes.tolist() == [10, 20, 30, 40]
+
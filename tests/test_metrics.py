@@ -0,0 +1,40 @@
+from collections import OrderedDict
+
+from giggle.metrics import (
+    Counter,
+    Gauge,
+    Histogram,
+    render,
+)
+
+
+def test_render():
+    registry = OrderedDict()
+    counter = Counter('requests_total', 'Requests.', ('route', ), registry=registry)
+    gauge = Gauge('in_flight', 'In-flight requests.', registry=registry)
+    counter.inc(route='/a')
+    counter.inc(2, route='/a')
+    gauge.inc()
+    gauge.dec()
+    lines = render(registry).splitlines()
+    assert lines[:3] == [
+        '# HELP requests_total Requests.',
+        '# TYPE requests_total counter',
+        'requests_total{route="/a"} 3',
+    ]
+    assert lines[-1] == 'in_flight 0'
+
+
+def test_histogram():
+    registry = OrderedDict()
+    histogram = Histogram('latency_seconds', 'Latency.', ('phase', ), buckets=(0.1, 1), registry=registry)
+    for value in (0.05, 0.1, 0.5, 2):
+        histogram.observe(value, phase='predict')
+    lines = render(registry).splitlines()
+    assert lines[2:] == [
+        'latency_seconds_bucket{phase="predict",le="0.1"} 2',
+        'latency_seconds_bucket{phase="predict",le="1.0"} 3',
+        'latency_seconds_bucket{phase="predict",le="+Inf"} 4',
+        'latency_seconds_sum{phase="predict"} 2.65',
+        'latency_seconds_count{phase="predict"} 4',
+    ]
@@ -0,0 +1,34 @@
+import time
+
+from giggle.profiling import (
+    PHASES,
+    SamplingProfiler,
+    phase,
+)
+
+
+def test_phase():
+    PHASES.clear()
+    for _ in range(2):
+        with phase('fit'):
+            with phase('similarity'):
+                pass
+    assert PHASES['fit'][1] == 2
+    assert PHASES['fit/similarity'][1] == 2
+    assert PHASES['fit'][0] >= PHASES['fit/similarity'][0]
+
+
+def test_sampling_profiler(tmpdir):
+    def busy():
+        end = time.time() + 0.1
+        while time.time() < end:
+            pass
+    profiler = SamplingProfiler(interval=0.001)
+    profiler.enable()
+    busy()
+    profiler.disable()
+    assert any(stack[-1].startswith('busy ') for stack in profiler.stacks)
+    path = str(tmpdir.join('profile.collapsed'))
+    profiler.write_collapsed(path)
+    with open(path) as f:
+        assert all(line.rsplit(' ', 1)[1].strip().isdigit() for line in f)
@@ -1,17 +1,41 @@
+import sys
+import threading
+
 import numpy as np
 
+import pytest
+
 from giggle.recommender import (
+    BaselineRecommender,
+    NR_SIMILAR_JOKES,
     RECOMMENDERS,
+    Neighbourhood,
+    Recommender,
+    load_recommender,
+    save_recommender,
+    top_n,
 )
 
 from giggle.data import (
     DATASETS,
+    data_to_sparse_user_joke_matrix,
+    data_to_user_joke_matrix,
 )
 
 
 dataset = DATASETS['small']()
 
 
+def get_rated(user_ids):
+    data_frame = dataset.data_frame
+    return [data_frame.joke_id.values[data_frame.user_id.values == user_id].tolist() for user_id in user_ids]
+
+
+def test_top_n():
+    scores = np.random.RandomState(0).randint(0, 4, (20, 10)).astype(float)
+    assert np.array_equal(top_n(scores, 4), np.argsort(-scores, axis=1, kind='mergesort')[:, :4])
+
+
 class TestBaseline:
 
     recommender = RECOMMENDERS['baseline']
@@ -30,6 +54,75 @@ class TestBaseline:
             assert curr_rmse - prev_rmse < TOL
             prev_rmse = curr_rmse
 
+    def test_sgd(self):
+        data = dataset.get_data()
+        als_rmse = BaselineRecommender(nr_epochs=10, lr=0.1, reg=0.1).fit(data, verbose=0)._compute_rmse(data.data_frame)
+        sgd_rmse = BaselineRecommender(nr_epochs=10, lr=0.1, reg=0.1, solver='sgd').fit(data, verbose=0)._compute_rmse(data.data_frame)
+        assert np.isfinite(sgd_rmse)
+        assert abs(sgd_rmse - als_rmse) < 0.02 * als_rmse
+        # The default learning rate converges slowly, but does not diverge
+        reco = BaselineRecommender(nr_epochs=10, lr=0.01, reg=0.1, solver='sgd').fit(data, verbose=0)
+        assert np.isfinite(reco._compute_rmse(data.data_frame))
+
+    def test_predict_multi(self):
+        reco = TestBaseline.recommender
+        reco.fit(dataset.get_data(), verbose=0)
+        user_joke_ids = dataset.data_frame[['user_id', 'joke_id']].values[:10]
+        preds = reco.predict_multi(user_joke_ids)
+        assert np.allclose(preds, [reco.predict(u, j) for u, j in user_joke_ids])
+        # Unknown users get only the joke bias
+        _, joke_id = user_joke_ids[0]
+        b_joke = reco.b_joke[dataset.joke_to_iid[joke_id]]
+        assert np.isclose(reco.predict(-1, joke_id), reco.mu + b_joke)
+
+    def test_recommend(self):
+        reco = TestBaseline.recommender
+        reco.fit(dataset.get_data(), verbose=0)
+        user_ids = dataset.users[:20].tolist() + [-1]
+        rated = get_rated(user_ids)
+        # Same as scoring and sorting all the unrated jokes
+        assert reco.recommend(user_ids, 5, rated=rated) == Recommender.recommend(reco, user_ids, 5, rated=rated)
+        for user_jokes, user_rated in zip(reco.recommend(user_ids, 5, rated=rated), rated):
+            assert len(user_jokes) <= 5
+            assert not set(user_jokes) & set(user_rated)
+        # The baseline does not keep the ratings, so it cannot exclude them
+        with pytest.raises(ValueError):
+            reco.recommend(user_ids, 5)
+        assert len(reco.recommend(user_ids, 5, exclude_rated=False)[0]) == 5
+
+
+    def test_concurrent_updates(self):
+        # Predictions for the users being added never see a partial update
+        reco = BaselineRecommender(nr_epochs=2, lr=0.01, reg=0.1).fit(dataset.get_data(), verbose=0)
+        user_ids = list(range(-1, -1001, -1))
+        joke_id = dataset.jokes[0]
+        user_joke_ids = [(user_id, joke_id) for user_id in user_ids]
+        done = threading.Event()
+        errors = []
+
+        def predict():
+            try:
+                while not done.is_set():
+                    reco.predict_multi(user_joke_ids)
+                    reco.recommend(user_ids[:1], 5, rated=[[]])
+            except Exception as e:
+                errors.append(e)
+
+        # Frequent thread switches, so that the threads interleave
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            thread = threading.Thread(target=predict)
+            thread.start()
+            for user_id in user_ids:
+                reco.update(user_id, joke_id, 1.0)
+            done.set()
+            thread.join()
+        finally:
+            sys.setswitchinterval(switch_interval)
+        assert not errors
+        assert len(reco.b_user) == len(reco.user_to_iid)
+
 
 class TestNeighbourhood:
 
@@ -42,8 +135,123 @@ class TestNeighbourhood:
         assert np.all(np.logical_and(-1 <= sims, sims <= 1))
         assert np.allclose(np.diag(sims), 1)
 
+    def test_sims_pearson(self):
+        reco = TestNeighbourhood.recommender
+        mat = data_to_user_joke_matrix(dataset.get_data())
+        for i, j in [(0, 1), (2, 7), (5, 3)]:
+            common = np.logical_and(~np.isnan(mat[:, i]), ~np.isnan(mat[:, j]))
+            r_i = mat[common, i] - mat[common, i].mean()
+            r_j = mat[common, j] - mat[common, j].mean()
+            sim = np.sum(r_i * r_j) / np.sqrt(np.sum(r_i ** 2) * np.sum(r_j ** 2))
+            assert np.isclose(reco.sims[i, j], sim)
+
+    def test_neighbours(self):
+        reco = TestNeighbourhood.recommender
+        nr_jokes, _ = reco.sims.shape
+        assert reco.neighbours.shape == (nr_jokes, nr_jokes - 1)
+        assert np.all(reco.neighbours != np.arange(nr_jokes)[:, np.newaxis])
+        assert np.all(np.diff(reco.neighbour_sims, axis=1) <= 0)
+
+    def test_similar_jokes(self):
+        reco = TestNeighbourhood.recommender
+        joke_id = dataset.jokes[0]
+        iids = np.argsort(-reco.sims[0])[1: NR_SIMILAR_JOKES + 1]
+        assert np.allclose(reco.similar_sims[0], reco.sims[0, iids])
+        assert joke_id not in reco.similar_jokes[0]
+
+    def test_predict_multi(self):
+        reco = TestNeighbourhood.recommender
+        user_joke_ids = dataset.data_frame[['user_id', 'joke_id']].values[:10]
+        preds = reco.predict_multi(user_joke_ids)
+        assert np.allclose(preds, [reco.predict(u, j) for u, j in user_joke_ids])
+
+    def test_update(self, monkeypatch):
+        # Some of the new ratings are merged into the matrix, others buffered
+        monkeypatch.setattr('giggle.recommender.MAX_NEW_RATINGS', 30)
+        data_frame = dataset.data_frame
+        held_out = data_frame.sample(100, random_state=0)
+        reco = Neighbourhood(k=35)
+        reco.fit(dataset.get_data(data_frame.drop(held_out.index)), verbose=0)
+        for _, u, j, r in held_out.itertuples():
+            reco.update(u, j, r)
+        assert reco.nr_new_ratings == 10
+        sims = TestNeighbourhood.recommender.sims
+        assert np.allclose(reco.sims, sims)
+        assert np.allclose(reco.similar_sims, TestNeighbourhood.recommender.similar_sims)
+        user_joke_ids = held_out[['user_id', 'joke_id']].values
+        assert np.allclose(reco.predict_multi(user_joke_ids), TestNeighbourhood.recommender.predict_multi(user_joke_ids))
+        reco._merge_new_ratings()
+        assert reco.user_joke_matrix.nnz == len(data_frame)
+        reco.update(-1, -1, 1.0)
+        assert reco.sims.shape == (len(sims) + 1, len(sims) + 1)
+        assert reco.predict(-1, -1) == reco.mu
+
     def test_user_joke_matrix(self):
         mat = TestNeighbourhood.recommender.user_joke_matrix
-        nr_users = len(TestNeighbourhood.recommender.data.users)
-        nr_jokes = len(TestNeighbourhood.recommender.data.jokes)
+        nr_users = len(dataset.users)
+        nr_jokes = len(dataset.jokes)
         assert mat.shape == (nr_users, nr_jokes)
+        assert mat.nnz == len(dataset.data_frame)
+
+    def test_save_load(self, tmpdir):
+        reco = TestNeighbourhood.recommender
+        path = str(tmpdir.join('neigh'))
+        save_recommender(path, reco)
+        loaded = load_recommender(path)
+        assert isinstance(loaded.sims, np.memmap)
+        assert loaded.user_to_iid == reco.user_to_iid
+        user_joke_ids = dataset.data_frame[['user_id', 'joke_id']].values[:100]
+        assert np.allclose(loaded.predict_multi(user_joke_ids), reco.predict_multi(user_joke_ids))
+
+    def test_nr_neighbours(self):
+        reco = TestNeighbourhood.recommender
+        nr_jokes = len(dataset.jokes)
+        sparse = Neighbourhood(k=reco.k, nr_neighbours=nr_jokes - 1).fit(dataset.get_data(), verbose=0)
+        assert sparse.sims is None
+        assert sparse.neighbour_sims.dtype == np.float32
+        assert np.array_equal(sparse.neighbours, reco.neighbours)
+        assert np.allclose(sparse.neighbour_sims, reco.neighbour_sims, atol=1e-6)
+        assert np.array_equal(sparse.similar_jokes, reco.similar_jokes)
+        # Only the top neighbours are kept
+        sparse = Neighbourhood(k=reco.k, nr_neighbours=10).fit(dataset.get_data(), verbose=0)
+        assert sparse.neighbours.shape == (nr_jokes, 10)
+        assert sparse.neighbours.dtype == np.int32
+        assert np.array_equal(sparse.neighbours, reco.neighbours[:, :10])
+        # The updates add the ratings, but leave the neighbours as fitted
+        neighbours = sparse.neighbours.copy()
+        sparse.update(dataset.users[0], dataset.jokes[0], 1.0)
+        sparse.update(-1, -1, 1.0)
+        assert np.array_equal(sparse.neighbours[:-1], neighbours)
+        assert sparse.neighbours.dtype == np.int32
+        assert sparse.predict(-1, -1) == sparse.mu
+
+    def test_recommend(self):
+        reco = TestNeighbourhood.recommender
+        user_ids = dataset.users[:20].tolist() + [-1]
+        # The rated jokes are known to the recommender
+        assert reco.recommend(user_ids, 5) == Recommender.recommend(reco, user_ids, 5, rated=get_rated(user_ids))
+
+
+class TestMatrixFactorization:
+
+    recommender = RECOMMENDERS['mf']
+    recommender.fit(dataset.get_data(), verbose=0)
+
+    def test_error_below_baseline(self):
+        reco = TestMatrixFactorization.recommender
+        base = RECOMMENDERS['baseline'].fit(dataset.get_data(), verbose=0)
+        rmse_reco = reco._compute_rmse(data_to_sparse_user_joke_matrix(dataset.get_data()))
+        rmse_base = base._compute_rmse(dataset.data_frame)
+        assert rmse_reco < rmse_base
+
+    def test_predict_multi(self):
+        reco = TestMatrixFactorization.recommender
+        user_joke_ids = dataset.data_frame[['user_id', 'joke_id']].values[:10]
+        preds = reco.predict_multi(user_joke_ids)
+        assert np.allclose(preds, [reco.predict(u, j) for u, j in user_joke_ids])
+
+    def test_recommend(self):
+        reco = TestMatrixFactorization.recommender
+        user_ids = dataset.users[:20].tolist() + [-1]
+        rated = get_rated(user_ids)
+        assert reco.recommend(user_ids, 5, rated=rated) == Recommender.recommend(reco, user_ids, 5, rated=rated)
@@ -0,0 +1,75 @@
+import time
+
+import numpy as np
+
+import pytest
+
+from giggle.recommender import BaselineRecommender
+
+from giggle.registry import (
+    VersionWatcher,
+    get_current_version,
+    get_version_order,
+    list_versions,
+    load_version,
+    save_version,
+    set_current_version,
+)
+
+
+def get_recommender(b_joke):
+    recommender = BaselineRecommender(nr_epochs=1, lr=0.1, reg=0.1)
+    recommender.mu = 0.0
+    recommender.b_user = np.array([0.0])
+    recommender.b_joke = np.array([b_joke])
+    recommender.user_to_iid = {1: 0}
+    recommender.joke_to_iid = {1: 0}
+    return recommender
+
+
+def test_versions(tmpdir, monkeypatch):
+    monkeypatch.chdir(str(tmpdir))
+    assert get_current_version('baseline') is None
+    v1 = save_version('baseline', get_recommender(1.0), promote=True)
+    v2 = save_version('baseline', get_recommender(2.0))
+    assert list_versions('baseline') == [v1, v2]
+    # Saving a version does not make it the current one by default
+    assert get_current_version('baseline') == v1
+    v3 = save_version('baseline', get_recommender(3.0), promote=True)
+    version, recommender = load_version('baseline')
+    assert version == v3
+    assert recommender.b_joke[0] == 3.0
+    assert load_version('baseline', v2)[1].b_joke[0] == 2.0
+    set_current_version('baseline', v1)
+    assert load_version('baseline')[0] == v1
+    with pytest.raises(ValueError):
+        set_current_version('baseline', 'unknown')
+    with pytest.raises(ValueError):
+        save_version('baseline', get_recommender(3.0), version=v1)
+    # Old versions are removed, except the current one
+    v4 = save_version('baseline', get_recommender(4.0), keep=1, promote=True)
+    assert list_versions('baseline') == [v4]
+
+
+def test_version_order():
+    versions = ['20240102-000000', 'latest', '20240101-000000-10', '20240101-000000', '20240101-000000-2']
+    assert sorted(versions, key=get_version_order) == [
+        '20240101-000000',
+        '20240101-000000-2',
+        '20240101-000000-10',
+        '20240102-000000',
+        'latest',
+    ]
+
+
+def test_version_watcher(tmpdir, monkeypatch):
+    monkeypatch.chdir(str(tmpdir))
+    save_version('baseline', get_recommender(1.0), promote=True)
+    seen = []
+    watcher = VersionWatcher('baseline', seen.append, interval=0.01)
+    watcher.ensure_started()
+    version = save_version('baseline', get_recommender(2.0), promote=True)
+    deadline = time.time() + 5
+    while not seen and time.time() < deadline:
+        time.sleep(0.01)
+    assert seen == [version]
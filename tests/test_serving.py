@@ -0,0 +1,51 @@
+import os
+import signal
+import socket
+import time
+
+from urllib.request import urlopen
+
+from giggle.serving import (
+    PreforkServer,
+    memory_usage,
+)
+
+
+def app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [str(os.getpid()).encode()]
+
+
+def get_free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def test_memory_usage():
+    usage = memory_usage(os.getpid())
+    assert usage['rss'] > 0
+
+
+def test_prefork_server():
+    port = get_free_port()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            PreforkServer(app, '127.0.0.1', port, nr_workers=2, graceful_timeout=5).run()
+        finally:
+            os._exit(0)
+    try:
+        worker_pids = set()
+        deadline = time.time() + 10
+        while len(worker_pids) < 2 and time.time() < deadline:
+            try:
+                worker_pids.add(int(urlopen('http://127.0.0.1:{:d}/'.format(port)).read()))
+            except (IOError, OSError):
+                time.sleep(0.05)
+        # The requests are served by the forked workers
+        assert worker_pids and pid not in worker_pids
+    finally:
+        os.kill(pid, signal.SIGTERM)
+        _, status = os.waitpid(pid, 0)
+    assert status == 0
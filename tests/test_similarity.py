@@ -0,0 +1,51 @@
+import os
+
+import numpy as np
+
+from giggle.data import (
+    DATASETS,
+    data_to_sparse_user_joke_matrix,
+)
+
+from giggle.recommender import Neighbourhood
+
+from giggle.similarity import (
+    BYTES_PER_BLOCK_ENTRY,
+    build_similarities,
+)
+
+
+dataset = DATASETS['small']()
+user_joke_matrix = data_to_sparse_user_joke_matrix(dataset.get_data())
+_, nr_jokes = user_joke_matrix.shape
+sims = Neighbourhood(k=35)._compute_similarities(user_joke_matrix)
+# Blocks of 7 jokes
+max_memory = 7 * BYTES_PER_BLOCK_ENTRY * nr_jokes
+
+
+def test_dense():
+    assert np.allclose(build_similarities(user_joke_matrix, max_memory=max_memory), sims, rtol=0, atol=1e-12)
+    assert np.allclose(build_similarities(user_joke_matrix, max_memory=max_memory, nr_jobs=2), sims, rtol=0, atol=1e-12)
+
+
+def test_memmap(tmpdir):
+    path = os.path.join(str(tmpdir), 'sims.npy')
+    blocked = build_similarities(user_joke_matrix, path=path, max_memory=max_memory, nr_jobs=2)
+    assert isinstance(blocked, np.memmap)
+    assert np.allclose(np.load(path), sims, rtol=0, atol=1e-12)
+
+
+def test_neighbours():
+    nr_neighbours = 10
+    neighbours, neighbour_sims = build_similarities(user_joke_matrix, nr_neighbours, max_memory=max_memory)
+    parallel = build_similarities(user_joke_matrix, nr_neighbours, max_memory=max_memory, nr_jobs=2)
+    assert np.array_equal(neighbours, parallel[0])
+    assert np.array_equal(neighbour_sims, parallel[1])
+    rows = np.arange(nr_jokes)[:, np.newaxis]
+    assert not np.any(neighbours == rows)
+    assert np.allclose(neighbour_sims, sims[rows, neighbours], atol=1e-6)
+    # No other joke is more similar than the last neighbour
+    others = sims.copy()
+    others[rows, neighbours] = -np.inf
+    np.fill_diagonal(others, -np.inf)
+    assert np.all(others.max(axis=1) <= neighbour_sims[:, -1] + 1e-6)
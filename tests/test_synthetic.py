@@ -0,0 +1,30 @@
+import numpy as np
+
+from giggle.synthetic import (
+    GAUGE_JOKES,
+    generate_data,
+    generate_ratings,
+)
+
+
+def test_generate_ratings():
+    data = generate_data(nr_users=300, nr_jokes=50, nr_ratings_per_user=20)
+    data_frame = data.data_frame
+    assert len(data.users) == 300
+    assert data_frame.rating.between(-10, 10).all()
+    assert not data_frame.duplicated(['user_id', 'joke_id']).any()
+    # Every user rated the gauge jokes
+    nr_gauge = data_frame[data_frame.joke_id.isin(GAUGE_JOKES)].groupby('user_id').size()
+    assert (nr_gauge == len(GAUGE_JOKES)).all()
+    assert abs(data_frame.groupby('user_id').size().mean() - 20) < 2
+
+
+def test_generate_ratings_chunks(monkeypatch):
+    # The chunks add up to the in-memory data, which is reproducible; the
+    # ratings drawn do depend on the chunk size, which is kept the same
+    monkeypatch.setattr('giggle.synthetic.MAX_CHUNK_ENTRIES', 30 * 20)
+    chunks = list(generate_ratings(nr_users=100, nr_jokes=20, seed=1))
+    data = generate_data(nr_users=100, nr_jokes=20, seed=1)
+    assert len(chunks) == 4
+    assert np.array_equal(np.vstack([chunk.values for chunk in chunks]), data.data_frame.values)
+    assert np.array_equal(generate_data(nr_users=100, nr_jokes=20, seed=1).data_frame.values, data.data_frame.values)
@@ -1,4 +1,8 @@
+import pickle
+import threading
+
 from giggle.utils import (
+    ReadWriteLock,
     grouper,
 )
 
@@ -7,3 +11,26 @@ def test_grouper():
     xs = [1, 2, 3, 4]
     assert list(grouper(xs, 3, None)) == [(1, 2, 3), (4, None, None)]
     assert list(grouper(xs, 1, None)) == [(1, ), (2, ), (3, ), (4, )]
+
+
+def test_read_write_lock():
+    lock = ReadWriteLock()
+    is_written = threading.Event()
+
+    def write():
+        with lock.writing():
+            is_written.set()
+
+    # Readers share the lock, the writer waits for them
+    with lock.reading():
+        with lock.reading():
+            pass
+        writer = threading.Thread(target=write)
+        writer.start()
+        assert not is_written.wait(0.1)
+    writer.join(5)
+    assert is_written.is_set()
+    # Copies in other processes are not locked
+    with lock.writing():
+        with pickle.loads(pickle.dumps(lock)).reading():
+            pass
@@ -0,0 +1,142 @@
+import importlib
+import json
+import os
+
+import numpy as np
+
+import pytest
+
+from sqlalchemy import create_engine  # type: ignore
+
+from giggle.models import (
+    db,
+    insert_ratings,
+)
+
+from giggle.recommender import BaselineRecommender
+
+from giggle.registry import (
+    get_current_version,
+    get_version_path,
+    load_version,
+    save_version,
+)
+
+from giggle.synthetic import generate_data
+
+
+CONFIG_PATH = os.path.abspath('config')
+
+
+@pytest.fixture
+def web_service(tmpdir, monkeypatch):
+    # A web service backed by a SQLite file and a baseline trained on it
+    monkeypatch.chdir(str(tmpdir))
+    os.symlink(CONFIG_PATH, 'config')
+    data = generate_data(nr_users=50, nr_jokes=40, nr_ratings_per_user=15)
+    engine = create_engine('sqlite:///ratings.db')
+    db.metadata.create_all(engine)
+    with engine.begin() as connection:
+        insert_ratings(connection, [data.data_frame])
+    save_version('baseline', BaselineRecommender(nr_epochs=2, lr=0.01, reg=0.1).fit(data, verbose=0), promote=True)
+    monkeypatch.setenv('DATABASE_URL', 'sqlite:///' + str(tmpdir.join('ratings.db')))
+    monkeypatch.setenv('SECRET_KEY', 'secret')
+    monkeypatch.setenv('RECOMMENDER', 'baseline')
+    monkeypatch.setenv('MODEL_POLL_SECONDS', '0')
+    monkeypatch.setenv('ADMIN_TOKEN', 'token')
+    monkeypatch.setenv('MAX_BATCH_USERS', '3')
+    monkeypatch.delenv('WRITE_BEHIND_MS', raising=False)
+    import giggle.config
+    import giggle.web_service
+    importlib.reload(giggle.config)
+    web_service = importlib.reload(giggle.web_service)
+    yield web_service
+    with web_service.app.app_context():
+        web_service.db.session.remove()
+        web_service.db.engine.dispose()
+
+
+def get_unrated(data_frame):
+    # The first joke, among the rated ones, that the first user did not rate
+    user_id = int(data_frame.user_id.values[0])
+    rated = set(data_frame.joke_id.values[data_frame.user_id.values == user_id].tolist())
+    return user_id, int(min(set(data_frame.joke_id.values.tolist()) - rated))
+
+
+def add_data(client, user_id, joke_id, rating):
+    data = json.dumps({'user': user_id, 'joke': joke_id, 'rating': rating})
+    return client.post('/addData/', data=data, content_type='application/json')
+
+
+def check_updated_once(web_service, user_id, joke_id, rating):
+    expected = load_version('baseline')[1]
+    expected.update(user_id, joke_id, rating)
+    recommender = web_service.model.recommender
+    assert np.allclose(recommender.b_user, expected.b_user)
+    assert np.allclose(recommender.b_joke, expected.b_joke)
+
+
+def test_add_data(web_service):
+    data = generate_data(nr_users=50, nr_jokes=40, nr_ratings_per_user=15)
+    user_id, joke_id = get_unrated(data.data_frame)
+    client = web_service.app.test_client()
+    assert add_data(client, user_id, joke_id, 5.0).status_code == 201
+    assert web_service.follower is None
+    assert joke_id in web_service.rating_index.get_rated_jokes(user_id)
+    check_updated_once(web_service, user_id, joke_id, 5.0)
+
+
+def test_predict_interests_batch(web_service):
+    client = web_service.app.test_client()
+    post = lambda body: client.post('/predictInterestsBatch/', data=json.dumps(body), content_type='application/json')
+    response = post({'users': [1, 2], 'n': 3})
+    assert response.status_code == 200
+    assert [len(jokes) for jokes in json.loads(response.data.decode()).values()] == [3, 3]
+    for body in [
+            {'users': ['abc']},
+            {'users': 1},
+            {'users': [1, True]},
+            {'users': [1, 2, 3, 4]},
+            {'users': [1], 'n': 0},
+            {'users': [1], 'n': -1},
+            {'users': [1], 'n': '5'}]:
+        assert post(body).status_code == 400
+
+
+def test_add_data_follower(web_service):
+    data = generate_data(nr_users=50, nr_jokes=40, nr_ratings_per_user=15)
+    user_id, joke_id = get_unrated(data.data_frame)
+    web_service.follow_ratings(2)
+    client = web_service.app.test_client()
+    assert add_data(client, user_id, joke_id, 5.0).status_code == 201
+    # The rating is applied from the log, and only once
+    assert web_service.follower.catch_up() == 0
+    check_updated_once(web_service, user_id, joke_id, 5.0)
+    assert joke_id in web_service.rating_index.get_rated_jokes(user_id)
+    # This process is the only reader, and it applied the whole log
+    web_service.follower.trim()
+    with web_service.app.app_context():
+        assert web_service.RatingLog.query.count() == 0
+
+
+def test_admin_reload(web_service):
+    client = web_service.app.test_client()
+    reload = lambda version, token='token': client.post(
+        '/admin/reload',
+        data=json.dumps({'version': version}),
+        content_type='application/json',
+        headers={'X-Admin-Token': token},
+    )
+    current = get_current_version('baseline')
+    version = save_version('baseline', load_version('baseline')[1])
+    assert reload(version, token='wrong').status_code == 403
+    assert reload('unknown').status_code == 404
+    # A version that fails to load is not made current
+    broken = save_version('baseline', load_version('baseline')[1])
+    os.remove(os.path.join(get_version_path('baseline', broken), 'b_joke.npy'))
+    assert reload(broken).status_code == 500
+    assert get_current_version('baseline') == current
+    assert web_service.model.version == current
+    assert reload(version).status_code == 200
+    assert get_current_version('baseline') == version
+    assert web_service.model.version == version